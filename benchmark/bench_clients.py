@@ -0,0 +1,89 @@
+"""比較每次呼叫建立新連線與共用連線池的連線數與延遲
+
+需要本機 MongoDB，於專案根目錄執行：
+    python -m benchmark.bench_clients --messages 200
+"""
+import argparse
+import time
+from pymongo import MongoClient, monitoring
+from linebot.v3.messaging import ApiClient, Configuration
+
+
+class ConnectionCounter(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.created = 0
+
+    def connection_created(self, event):
+        self.created += 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_out(self, event): pass
+    def connection_checked_in(self, event): pass
+
+
+def simulate_message(get_mongo, get_line, session_id):
+    """模擬一則訊息的資料庫存取：兩次讀取歷史、兩次寫入、一次記帳查詢"""
+    for _ in range(2):
+        get_mongo()["bench"]["chat_records"].find_one({"SessionId": session_id})
+    for _ in range(2):
+        get_mongo()["bench"]["chat_records"].insert_one({"SessionId": session_id})
+    get_mongo()["bench"]["records"].find_one({"user_id": session_id})
+    get_line()
+
+
+def run(label, get_mongo, get_line, messages, counter):
+    before = counter.created
+    latencies = []
+    for i in range(messages):
+        start = time.perf_counter()
+        simulate_message(get_mongo, get_line, f"bench_{i % 10}")
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(
+        f"{label:8s} connections={counter.created - before:5d} "
+        f"p50={latencies[len(latencies) // 2] * 1000:.2f}ms "
+        f"p95={latencies[int(len(latencies) * 0.95)] * 1000:.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--uri", default="mongodb://localhost:27017/")
+    args = parser.parse_args()
+
+    counter = ConnectionCounter()
+    monitoring.register(counter)
+    configuration = Configuration(access_token="bench")
+
+    opened = []
+
+    def legacy_mongo():
+        client = MongoClient(args.uri)
+        opened.append(client)
+        return client
+
+    def legacy_line():
+        with ApiClient(configuration):
+            pass
+
+    run("legacy", legacy_mongo, legacy_line, args.messages, counter)
+    for client in opened:
+        client.close()
+
+    shared_mongo = MongoClient(args.uri, maxPoolSize=20)
+    shared_line = ApiClient(configuration)
+    run("pooled", lambda: shared_mongo, lambda: shared_line, args.messages, counter)
+    shared_mongo["bench"].command("dropDatabase")
+    shared_mongo.close()
+
+
+if __name__ == "__main__":
+    main()
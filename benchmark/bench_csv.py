@@ -0,0 +1,90 @@
+"""量測 CSV 匯入（bulk_write）與串流匯出的吞吐量，並與逐筆 insert_one 比較
+
+需要本機 MongoDB，使用 bench_csv 資料庫並於結束時刪除。於專案根目錄執行：
+    python -m benchmark.bench_csv --rows 100000
+"""
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from pymongo import MongoClient
+from script.csv_io import import_csv, export_csv, read_rows, validate_row
+from script.manay import rollup_increments
+
+ITEMS = [("午餐", "飲食"), ("捷運", "交通"), ("電影", "娛樂"), ("房租", "住宿"), ("書", "教育")]
+
+
+def generate(path, rows, seed=1):
+    rng = random.Random(seed)
+    start = date(2020, 1, 1)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        f.write("日期,類型,金額,項目,分類\n")
+        for _ in range(rows):
+            day = start + timedelta(days=rng.randrange(365 * 5))
+            if rng.random() < 0.1:
+                f.write(f"{day.isoformat()},收入,{rng.randrange(1000, 60000)},薪水,\n")
+            else:
+                item, category = rng.choice(ITEMS)
+                f.write(f"{day.isoformat()},支出,{rng.randrange(20, 3000)},{item},{category}\n")
+
+
+def peak_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--baseline-rows", type=int, default=2000, help="逐筆寫入比較的列數")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--uri", default="mongodb://localhost:27017/")
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    db = client["bench_csv"]
+    db.records.create_index([("user_id", 1), ("date", 1)])
+    db.monthly_totals.create_index([("user_id", 1), ("year", 1), ("month", 1)], unique=True)
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-csv-"), "records.csv")
+    generate(path, args.rows)
+    print(f"CSV {args.rows} 列，{os.path.getsize(path) / 1024 / 1024:.1f}MB")
+
+    try:
+        start = time.perf_counter()
+        with open(path, newline="", encoding="utf-8") as f:
+            stats = import_csv(db, "bench_user", f, args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(
+            f"bulk     {stats['imported'] / elapsed:10.0f} rows/s "
+            f"({elapsed:.1f}s, batch {args.batch_size}, peak RSS {peak_rss_mb():.0f}MB)"
+        )
+
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = [validate_row(row) for _, row in itertools.islice(read_rows(f), args.baseline_rows)]
+        start = time.perf_counter()
+        for record in rows:
+            record["user_id"] = "bench_baseline"
+            db.records.insert_one(record)
+            db.monthly_totals.update_one(
+                {"user_id": record["user_id"], "year": record["year"], "month": record["month"]},
+                {"$inc": rollup_increments(record)},
+                upsert=True,
+            )
+        elapsed = time.perf_counter() - start
+        print(f"逐筆     {len(rows) / elapsed:10.0f} rows/s ({len(rows)} 列)")
+
+        start = time.perf_counter()
+        with open(os.devnull, "w", newline="", encoding="utf-8") as out:
+            count = export_csv(db, "bench_user", out, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"匯出     {count / elapsed:10.0f} rows/s ({elapsed:.1f}s, peak RSS {peak_rss_mb():.0f}MB)")
+    finally:
+        client.drop_database("bench_csv")
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""比較 webhook 事件全部轉成 SDK 物件與先以原始 JSON 過濾的 CPU 時間
+
+模擬繁忙群組：每個 webhook 含多則群組訊息，只有少數提及機器人。
+基準為 WebhookParser.parse（原本 WebhookHandler.handle 的作法）；過濾路徑為驗證簽章、json.loads、
+丟棄不會回覆的事件，剩下的才 Event.from_dict。於專案根目錄執行：
+    python -m benchmark.bench_prefilter --bodies 2000 --events 20 --mention-rate 0.02
+"""
+import argparse
+import json
+import random
+import time
+from linebot.v3.webhook import WebhookParser
+from linebot.v3.webhooks import Event
+from benchmark.loadtest import CHANNEL_SECRET, BOT_USER_ID, CHAT_TEXTS, sign, group_event, text_event
+from script.webhook_filter import WebhookFilter
+
+
+def build_bodies(count, events_per_body, mention_rate, user_rate, seed=1):
+    rng = random.Random(seed)
+    bodies = []
+    for i in range(count):
+        events = []
+        for j in range(events_per_body):
+            text = CHAT_TEXTS[(i + j) % len(CHAT_TEXTS)]
+            roll = rng.random()
+            if roll < user_rate:
+                events.append(text_event(f"U{i:06d}", text))
+            else:
+                events.append(group_event(f"U{j:06d}", "Gbench", text, roll < user_rate + mention_rate))
+        body = json.dumps({"destination": BOT_USER_ID, "events": events}, ensure_ascii=False)
+        bodies.append((body, sign(body)))
+    return bodies
+
+
+def run_baseline(parser, bodies):
+    parsed = 0
+    start = time.process_time()
+    for body, signature in bodies:
+        parsed += len(parser.parse(body, signature))
+    return time.process_time() - start, parsed
+
+
+def run_prefilter(parser, webhook_filter, bodies):
+    parsed = 0
+    start = time.process_time()
+    for body, signature in bodies:
+        if not parser.signature_validator.validate(body, signature):
+            raise ValueError("簽章錯誤")
+        for event in webhook_filter.filter(json.loads(body).get("events", [])):
+            Event.from_dict(event)
+            parsed += 1
+    return time.process_time() - start, parsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bodies", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=20, help="每個 webhook 的事件數")
+    parser.add_argument("--mention-rate", type=float, default=0.02, help="提及機器人的群組訊息比例")
+    parser.add_argument("--user-rate", type=float, default=0.0, help="個人對話訊息比例")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    bodies = build_bodies(args.bodies, args.events, args.mention_rate, args.user_rate)
+    line_parser = WebhookParser(CHANNEL_SECRET)
+    webhook_filter = WebhookFilter()
+    total = args.bodies * args.events
+    baseline = min(run_baseline(line_parser, bodies)[0] for _ in range(args.repeat))
+    runs = [run_prefilter(line_parser, webhook_filter, bodies) for _ in range(args.repeat)]
+    prefilter, parsed = min(runs)
+    print(f"{args.bodies} 個 webhook，共 {total} 個事件，完整解析 {parsed} 個")
+    print(f"全部解析 {baseline * 1e6 / total:8.1f} us/事件 ({baseline:.2f}s)")
+    print(f"先過濾   {prefilter * 1e6 / total:8.1f} us/事件 ({prefilter:.2f}s)")
+    print(f"節省 CPU {1 - prefilter / baseline:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""以標註語料評估 QuickParser 的準確率與可省下的 LLM 延遲
+
+於專案根目錄執行：
+    python -m benchmark.bench_quick_parser --llm-latency 1.8
+"""
+import argparse
+import json
+import time
+from datetime import date, timedelta
+from script.quick_parser import QuickParser
+
+
+def expected_date(expected, today):
+    if "day_offset" in expected:
+        return today + timedelta(days=expected["day_offset"])
+    if "weekday_last_week" in expected:
+        monday = today - timedelta(days=today.weekday() + 7)
+        return monday + timedelta(days=expected["weekday_last_week"])
+    if "month" in expected:
+        return date(today.year, expected["month"], expected["day"])
+    return None
+
+
+def is_correct(result, expected, today):
+    for key in ("type", "amount", "category"):
+        if key in expected and result[key] != expected[key]:
+            return False
+    record_date = expected_date(expected, today)
+    if record_date is None:
+        return result["year"] is None
+    return (result["year"], result["month"], result["day"]) == (
+        record_date.year, record_date.month, record_date.day
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default="benchmark/accounting_corpus.jsonl")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--llm-latency", type=float, default=1.5, help="單次 LLM 記帳解析的平均秒數")
+    parser.add_argument("--today", default="2026-10-18")
+    args = parser.parse_args()
+
+    today = date.fromisoformat(args.today)
+    samples = [json.loads(line) for line in open(args.corpus, encoding="utf-8") if line.strip()]
+    accepted = correct = false_accept = deferred_ok = 0
+    elapsed = 0.0
+    for sample in samples:
+        start = time.perf_counter()
+        result = QuickParser.parse(sample["message"], today=today)
+        elapsed += time.perf_counter() - start
+        expected = sample["expected"]
+        confident = result is not None and result["confidence"] >= args.threshold
+        if expected.get("llm"):
+            if confident:
+                false_accept += 1
+                print(f"誤判為記帳: {sample['message']} -> {result}")
+            else:
+                deferred_ok += 1
+            continue
+        if confident:
+            accepted += 1
+            if is_correct(result, expected, today):
+                correct += 1
+            else:
+                print(f"解析錯誤: {sample['message']} -> {result}")
+        else:
+            print(f"交給 LLM: {sample['message']} -> {result}")
+
+    bookkeeping = sum(1 for s in samples if not s["expected"].get("llm"))
+    print(f"樣本數: {len(samples)}（記帳 {bookkeeping}）")
+    print(f"本地處理率: {accepted / bookkeeping:.1%}  準確率: {correct / max(accepted, 1):.1%}")
+    print(f"非記帳誤判: {false_accept}  正確轉交 LLM: {deferred_ok}")
+    print(f"平均解析時間: {elapsed / len(samples) * 1e6:.1f}µs")
+    print(f"省下的 LLM 延遲: {accepted * args.llm_latency:.1f}s（{accepted} 次呼叫）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""比較不同版本的冷啟動時間與每個 worker 的私有記憶體
+
+每個版本以 git archive 展開到暫存目錄，在獨立程序中量測：
+匯入 main（與 create_app）的時間與 RSS，以及 fork 後 worker 初始化的時間與私有記憶體。
+--preload 模擬 gunicorn preload_app，先在 master 匯入重量級模組再 fork。
+MongoDB 以 mongomock 取代。於專案根目錄執行：
+    python -m benchmark.bench_startup --revisions a19391b,HEAD --preload
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from types import SimpleNamespace
+from benchmark.loadtest import REPO_ROOT, prepare_workdir
+
+CHILD = r"""
+import json, os, sys, time
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+def private_mb():
+    total = 0
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                total += int(line.split()[1])
+    return total / 1024
+
+import mongomock
+from script.clients import registry
+registry._mongo = mongomock.MongoClient()
+
+start = time.perf_counter()
+import main
+app = main.create_app() if hasattr(main, "create_app") else main.app
+result = {"import_s": time.perf_counter() - start, "master_rss_mb": rss_mb()}
+if PRELOAD:
+    start = time.perf_counter()
+    if hasattr(main, "services"):
+        from script.services import preload
+        preload()
+    result["preload_s"] = time.perf_counter() - start
+    result["master_rss_mb"] = rss_mb()
+
+read_fd, write_fd = os.pipe()
+pid = os.fork()
+if pid == 0:
+    os.close(read_fd)
+    start = time.perf_counter()
+    if hasattr(main, "warmup"):
+        main.warmup()
+    else:
+        from script.gai import IntelligentChatAssistant
+        from script.manay import Accounting
+        main.ai = IntelligentChatAssistant()
+        main.ac = Accounting()
+    worker = {"warmup_s": time.perf_counter() - start, "worker_private_mb": private_mb()}
+    os.write(write_fd, json.dumps(worker).encode())
+    os._exit(0)
+os.close(write_fd)
+os.waitpid(pid, 0)
+result.update(json.loads(os.read(read_fd, 65536)))
+print(json.dumps(result))
+"""
+
+
+def extract(revision):
+    """將指定版本的原始碼展開到暫存目錄"""
+    directory = tempfile.mkdtemp(prefix=f"mybot-{revision}-")
+    archive = subprocess.run(
+        ["git", "archive", revision], cwd=REPO_ROOT, check=True, capture_output=True
+    ).stdout
+    subprocess.run(["tar", "-x", "-C", directory], input=archive, check=True)
+    return directory
+
+
+def measure(revision, preload, model):
+    source = extract(revision)
+    args = SimpleNamespace(model=model, mongo="mongomock", async_webhook=False)
+    workdir, _ = prepare_workdir(args, "http://127.0.0.1:9", "http://127.0.0.1:9", source_root=source)
+    os.makedirs(os.path.join(workdir, "log"), exist_ok=True)  # 較舊版本直接寫入 ./log
+    env = dict(os.environ, PYTHONPATH=source)
+    output = subprocess.run(
+        [sys.executable, "-c", f"PRELOAD = {preload}\n" + CHILD],
+        cwd=workdir, env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--revisions", default="HEAD~1,HEAD")
+    parser.add_argument("--preload", action="store_true", help="fork 前先匯入重量級模組")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--model", default="gpt-4.1-mini")
+    args = parser.parse_args()
+
+    for revision in args.revisions.split(","):
+        runs = [measure(revision, args.preload, args.model) for _ in range(args.repeat)]
+        best = {key: min(run.get(key, 0) for run in runs) for key in runs[0]}
+        print(
+            f"{revision:10s} import={best['import_s']:.2f}s "
+            f"preload={best.get('preload_s', 0):.2f}s warmup={best['warmup_s']:.2f}s "
+            f"master_rss={best['master_rss_mb']:.0f}MB worker_private={best['worker_private_mb']:.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""以帶正確簽章的 webhook 對 /callback 施壓，量測各情境的吞吐量、延遲與記憶體成長
+
+OpenAI 與 LINE 由 benchmark.stubs 的本機替身取代，MongoDB 預設使用 mongomock
+（或以 --mongo 指定一個可清空的本機實例）。結果寫入 benchmark/results/，
+可用 --compare 與先前的結果比較。於專案根目錄執行：
+    python -m benchmark.loadtest --requests 200 --concurrency 16 --llm-latency 0.8
+    python -m benchmark.loadtest --scenarios chat_text,receipt_image --compare benchmark/results/<舊結果>.json
+
+history_compactor 需要 tiktoken 的編碼檔，離線環境請先設定 TIKTOKEN_CACHE_DIR。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from benchmark.stubs import StubServer, LineStub, openai_handler
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = "loadtest-channel-secret"
+BOT_USER_ID = "Uloadtestbot"
+
+CHAT_TEXTS = ["推薦台北的早午餐", "明天適合去爬山嗎", "幫我想一個生日禮物", "解釋一下複利"]
+QUICK_TEXTS = ["午餐120", "早餐65", "計程車280", "咖啡55"]
+LLM_TEXTS = ["幫朋友墊了一些錢大概三百", "昨天的聚餐費用還沒記"]
+MULTI_TEXTS = ["早餐50 午餐120 晚餐200 停車費60", "昨天 咖啡55、計程車280"]
+
+
+def sign(body):
+    """LINE 的 X-Line-Signature：以 channel secret 對內容做 HMAC-SHA256 後 base64"""
+    digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def _base_event(source):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": uuid.uuid4().hex.upper(),
+        "deliveryContext": {"isRedelivery": False},
+        "source": source,
+        "replyToken": uuid.uuid4().hex,
+    }
+
+
+def text_event(user_id, text):
+    event = _base_event({"type": "user", "userId": user_id})
+    event["message"] = {"type": "text", "id": uuid.uuid4().hex[:18], "quoteToken": "q", "text": text}
+    return event
+
+
+def image_event(user_id):
+    event = _base_event({"type": "user", "userId": user_id})
+    event["message"] = {
+        "type": "image", "id": uuid.uuid4().hex[:18], "quoteToken": "q",
+        "contentProvider": {"type": "line"},
+    }
+    return event
+
+
+def group_event(user_id, group_id, text, mentioned):
+    event = _base_event({"type": "group", "groupId": group_id, "userId": user_id})
+    message = {"type": "text", "id": uuid.uuid4().hex[:18], "quoteToken": "q", "text": text}
+    if mentioned:
+        message["text"] = "@mybot " + text
+        message["mention"] = {"mentionees": [{
+            "index": 0, "length": 6, "type": "user", "userId": BOT_USER_ID, "isSelf": True,
+        }]}
+    event["message"] = message
+    return event
+
+
+def _pick(items, i):
+    return items[i % len(items)]
+
+
+def build_events(scenario, i, users):
+    """第 i 個請求的事件列表"""
+    user_id = f"Uloadtest{i % users:04d}"
+    group_id = f"Cloadtest{i % max(1, users // 10):03d}"
+    if scenario == "chat_text":
+        return [text_event(user_id, _pick(CHAT_TEXTS, i))]
+    if scenario == "quick_bookkeeping":
+        return [text_event(user_id, _pick(QUICK_TEXTS, i))]
+    if scenario == "llm_bookkeeping":
+        return [text_event(user_id, _pick(LLM_TEXTS, i))]
+    if scenario == "multi_bookkeeping":
+        return [text_event(user_id, _pick(MULTI_TEXTS, i))]
+    if scenario == "receipt_image":
+        return [image_event(user_id)]
+    if scenario == "group_mention":
+        return [group_event(user_id, group_id, _pick(CHAT_TEXTS, i), mentioned=True)]
+    if scenario == "group_noise":
+        return [group_event(user_id, group_id, _pick(CHAT_TEXTS, i), mentioned=False)]
+    if scenario == "batch":
+        return [
+            group_event(user_id, group_id, _pick(CHAT_TEXTS, i), mentioned=False),
+            group_event(user_id, group_id, _pick(CHAT_TEXTS, i + 1), mentioned=False),
+            text_event(user_id, _pick(QUICK_TEXTS, i)),
+            group_event(user_id, group_id, _pick(CHAT_TEXTS, i + 2), mentioned=True),
+            group_event(user_id, group_id, _pick(CHAT_TEXTS, i + 3), mentioned=False),
+        ]
+    raise ValueError(f"未知情境: {scenario}")
+
+
+SCENARIOS = (
+    "chat_text", "quick_bookkeeping", "llm_bookkeeping", "multi_bookkeeping", "receipt_image",
+    "group_mention", "group_noise", "batch",
+)
+
+
+def expects_reply(event):
+    source = event["source"]
+    if source["type"] == "user":
+        return True
+    return "mention" in event["message"]
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": _ms(percentile(latencies, 0.50)),
+        "p95_ms": _ms(percentile(latencies, 0.95)),
+        "p99_ms": _ms(percentile(latencies, 0.99)),
+        "max_ms": _ms(max(latencies) if latencies else None),
+    }
+
+
+def _ms(value):
+    return round(value * 1000, 2) if value is not None else None
+
+
+def prepare_workdir(args, openai_url, line_url, source_root=REPO_ROOT):
+    """建立暫存工作目錄（config、secret、prompt），程式以相對路徑讀取這些檔案"""
+    workdir = tempfile.mkdtemp(prefix="mybot-loadtest-")
+    os.makedirs(os.path.join(workdir, "config"))
+    os.symlink(os.path.join(source_root, "prompt"), os.path.join(workdir, "prompt"))
+    config = {
+        "host": "127.0.0.1",
+        "port": 0,
+        "debug": False,
+        "url": "loadtest.invalid",
+        "model": args.model,
+        "mongo_uri": args.mongo if args.mongo != "mongomock" else "mongodb://localhost:27017/",
+        "async_webhook": args.async_webhook,
+        "queue_path": os.path.join(workdir, "queue", "events.db"),
+        "logging": {"directory": os.path.join(workdir, "log")},
+        "image_store": {"directory": os.path.join(workdir, "images")},
+        "clients": {
+            "openai_base_url": openai_url + "/v1",
+            "line_host": line_url,
+            "openai_max_retries": 0,
+        },
+        "llm_gateway": {"backoff_base": 0.05, "backoff_cap": 0.2},
+    }
+    secret = {"channel_secret": CHANNEL_SECRET, "access_token": "loadtest-token", "openai": "sk-loadtest"}
+    with open(os.path.join(workdir, "config", "config.json"), "w") as f:
+        json.dump(config, f)
+    with open(os.path.join(workdir, "config", "secret.json"), "w") as f:
+        json.dump(secret, f)
+    return workdir, config
+
+
+def load_app(args):
+    """以 create_app() 建立 app 並完成 worker 初始化"""
+    sys.path.insert(0, REPO_ROOT)
+    from script.clients import registry
+    if args.mongo == "mongomock":
+        import mongomock
+        registry._mongo = mongomock.MongoClient()
+    import main
+
+    app = main.create_app()
+    main.warmup()
+    return app
+
+
+def run_scenario(app, line_stub, scenario, args):
+    local = threading.local()
+    http_latencies, reply_sent, failures = [], [], 0
+    lock = threading.Lock()
+
+    def send(i):
+        nonlocal failures
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        events = build_events(scenario, i, args.users)
+        body = json.dumps({"destination": BOT_USER_ID, "events": events}, ensure_ascii=False)
+        start = time.perf_counter()
+        response = client.post(
+            "/callback", data=body.encode(), content_type="application/json",
+            headers={"X-Line-Signature": sign(body)},
+        )
+        elapsed = time.perf_counter() - start
+        with lock:
+            http_latencies.append(elapsed)
+            if response.status_code != 200:
+                failures += 1
+            reply_sent.extend(
+                (e["replyToken"], start) for e in events if expects_reply(e)
+            )
+
+    rss_before = rss_bytes()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, range(args.requests)))
+    # 非同步模式下回覆晚於 HTTP 回應，等待佇列處理完畢
+    deadline = time.perf_counter() + args.drain_timeout
+    while time.perf_counter() < deadline:
+        if all(line_stub.reply_time(token) for token, _ in reply_sent):
+            break
+        time.sleep(0.05)
+    wall = time.perf_counter() - started
+
+    reply_latencies, missing = [], 0
+    for token, sent_at in reply_sent:
+        replied_at = line_stub.reply_time(token)
+        if replied_at is None:
+            missing += 1
+        else:
+            reply_latencies.append(replied_at - sent_at)
+    return {
+        "requests": args.requests,
+        "events": sum(len(build_events(scenario, i, args.users)) for i in range(args.requests)),
+        "http_failures": failures,
+        "throughput_rps": round(args.requests / wall, 2),
+        "http": summarize(http_latencies),
+        "reply": summarize(reply_latencies),
+        "replies_missing": missing,
+        "rss_growth_mb": round((rss_bytes() - rss_before) / 1024 / 1024, 2),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current, previous_path):
+    previous = json.load(open(previous_path, encoding="utf-8"))
+    print(f"\n與 {previous['revision']} 比較：")
+    for scenario, result in current["scenarios"].items():
+        before = previous["scenarios"].get(scenario)
+        if before is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            old, new = before["reply"][key], result["reply"][key]
+            if old and new:
+                print(f"  {scenario:18s} reply {key:7s} {old:9.1f} -> {new:9.1f} ({(new - old) / old:+.1%})")
+        old, new = before["throughput_rps"], result["throughput_rps"]
+        print(f"  {scenario:18s} throughput     {old:9.1f} -> {new:9.1f} ({(new - old) / old:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="每個情境的 webhook 請求數")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--model", default="gpt-4.1-mini")
+    parser.add_argument("--mongo", default="mongomock", help="mongomock 或可清空的 MongoDB URI")
+    parser.add_argument("--async-webhook", action="store_true", help="以持久化佇列模式處理事件")
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--llm-jitter", type=float, default=0.3)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--line-latency", type=float, default=0.03)
+    parser.add_argument("--line-error-rate", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="結果檔，預設 benchmark/results/loadtest-<revision>-<時間>.json")
+    parser.add_argument("--compare", default=None, help="要比較的先前結果檔")
+    args = parser.parse_args()
+
+    openai_stub = StubServer(
+        openai_handler, args.llm_latency, args.llm_jitter, args.llm_error_rate, seed=args.seed
+    ).start()
+    line_stub = LineStub()
+    line_server = StubServer(
+        line_stub.handle, args.line_latency, args.line_latency / 2, args.line_error_rate, seed=args.seed
+    ).start()
+    workdir, _ = prepare_workdir(args, openai_stub.url, line_server.url)
+    output = os.path.abspath(args.output) if args.output else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    os.chdir(workdir)
+    app = load_app(args)
+
+    revision = git_revision()
+    results = {
+        "revision": revision,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "args": vars(args),
+        "scenarios": {},
+    }
+    for scenario in args.scenarios.split(","):
+        result = run_scenario(app, line_stub, scenario, args)
+        results["scenarios"][scenario] = result
+        print(
+            f"{scenario:18s} rps={result['throughput_rps']:7.1f} "
+            f"reply p50={result['reply']['p50_ms']}ms p95={result['reply']['p95_ms']}ms "
+            f"p99={result['reply']['p99_ms']}ms missing={result['replies_missing']} "
+            f"http p95={result['http']['p95_ms']}ms rss+={result['rss_growth_mb']}MB"
+        )
+    results["stubs"] = {"openai": openai_stub.stats(), "line": line_server.stats()}
+
+    if output is None:
+        directory = os.path.join(REPO_ROOT, "benchmark", "results")
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, f"loadtest-{revision}-{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {output}")
+    if compare_path:
+        compare(results, compare_path)
+    openai_stub.stop()
+    line_server.stop()
+    os._exit(0)  # 背景執行緒（歷史寫入、摘要、排程器）不需等待
+
+
+if __name__ == "__main__":
+    main()
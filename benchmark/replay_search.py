@@ -0,0 +1,132 @@
+"""以 chat_records 中的真實提問離線重播，比較附加與不附加 web_search 工具的延遲與 token
+
+先統計 SearchPolicy 對所有提問的判斷，再抽樣 --sample 則提問，
+各以「附加工具」與「不附加工具」呼叫模型一次（順序交替），依判斷結果分組輸出
+平均延遲、輸入/輸出 token，以及附加工具時模型實際搜尋的比例
+（判斷為不需搜尋、模型卻實際搜尋的比例即為可能漏判的上限）。
+會實際呼叫 OpenAI，可用 config 的 openai_base_url 指向替身。於專案根目錄執行：
+    python -m benchmark.replay_search --sample 50
+"""
+import argparse
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from script.clients import registry, config
+from script.prompts import prompts
+from script.search_policy import SearchPolicy
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+TOOLS = [{"type": "web_search_preview"}]
+
+
+def load_queries(collection, context_size, limit=None):
+    """依會話還原對話，回傳每則文字提問與其之前的對話"""
+    sessions = defaultdict(list)
+    cursor = collection.find({}, {"SessionId": 1, "History": 1}).sort("_id", 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    queries = []
+    for document in cursor:
+        message = json.loads(document["History"])
+        content = message.get("data", {}).get("content")
+        if not isinstance(content, str):
+            continue
+        role = "user" if message.get("type") == "human" else "assistant"
+        history = sessions[document["SessionId"]]
+        if role == "user" and content and not content.startswith("[圖片]"):
+            queries.append({"text": content, "history": history[-context_size:]})
+        history.append({"role": role, "content": content})
+    return queries
+
+
+def call(model, query, use_search):
+    kwargs = {"tools": TOOLS} if use_search else {}
+    start = time.perf_counter()
+    response = registry.openai().responses.create(
+        model=model,
+        input=[
+            {"role": "system", "content": prompts.text("prompt")},
+            *query["history"],
+            {"role": "user", "content": query["text"]},
+        ],
+        **kwargs,
+    )
+    latency = time.perf_counter() - start
+    usage = response.usage
+    return {
+        "latency": latency,
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "searched": any(getattr(item, "type", None) == "web_search_call" for item in response.output),
+    }
+
+
+def summarize(runs):
+    if not runs:
+        return None
+    count = len(runs)
+    return {
+        "count": count,
+        "latency_avg": sum(r["latency"] for r in runs) / count,
+        "input_tokens_avg": sum(r["input_tokens"] for r in runs) / count,
+        "output_tokens_avg": sum(r["output_tokens"] for r in runs) / count,
+        "searched_rate": sum(r["searched"] for r in runs) / count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", type=int, default=50, help="實際呼叫模型比較的提問數")
+    parser.add_argument("--limit", type=int, default=None, help="最多讀取的歷史記錄筆數")
+    parser.add_argument("--context", type=int, default=6, help="每則提問附帶的先前訊息數")
+    parser.add_argument("--classifier-model", default=None)
+    parser.add_argument("--model", default=config["model"])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    collection = registry.mongo()["line_chat_history"]["chat_records"]
+    queries = load_queries(collection, args.context, args.limit)
+    policy = SearchPolicy(classifier_model=args.classifier_model)
+    for query in queries:
+        query["use_search"], query["reason"] = policy.decide(query["text"])
+    searched = sum(q["use_search"] for q in queries)
+    print(f"{len(queries)} 則提問，判斷需要搜尋 {searched} 則 ({searched / max(1, len(queries)):.0%})")
+    for decision, reasons in policy.stats().items():
+        print(f"  {decision:10s} {reasons}")
+
+    rng = random.Random(args.seed)
+    sample = rng.sample(queries, min(args.sample, len(queries)))
+    runs = {(decision, tool): [] for decision in (True, False) for tool in (True, False)}
+    for i, query in enumerate(sample):
+        order = (True, False) if i % 2 == 0 else (False, True)
+        for use_search in order:
+            try:
+                runs[(query["use_search"], use_search)].append(call(args.model, query, use_search))
+            except Exception as e:
+                print(f"呼叫失敗: {e}")
+
+    result = {"queries": len(queries), "policy": policy.stats(), "model": args.model, "groups": {}}
+    print(f"\n抽樣 {len(sample)} 則：")
+    for decision in (True, False):
+        label = "判斷需搜尋" if decision else "判斷不需搜尋"
+        for tool in (True, False):
+            summary = summarize(runs[(decision, tool)])
+            result["groups"][f"{'search' if decision else 'no_search'}/{'tool' if tool else 'no_tool'}"] = summary
+            if summary is None:
+                continue
+            print(
+                f"  {label} {'附加工具' if tool else '不附加':6s} n={summary['count']:3d} "
+                f"延遲 {summary['latency_avg']:.2f}s 輸入 {summary['input_tokens_avg']:.0f} "
+                f"輸出 {summary['output_tokens_avg']:.0f} 實際搜尋 {summary['searched_rate']:.0%}"
+            )
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"replay_search-{int(time.time())}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {path}")
+
+
+if __name__ == "__main__":
+    main()
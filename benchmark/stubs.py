@@ -0,0 +1,261 @@
+"""壓力測試用的 OpenAI Responses API 與 LINE Messaging API 本機替身
+
+每個替身都是獨立的 HTTP 伺服器，可設定延遲、抖動與錯誤率，
+LINE 替身另外記錄每個 reply token 收到回覆的時間，用來計算端對端延遲。
+"""
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ACCOUNTING_MARKER = "請詳細分析使用者最後一則訊息中的記帳內容"
+SUMMARY_MARKER = "滾動摘要"
+# OpenAI 的 prompt caching 只在前綴至少 1024 token 時生效，並以 128 token 為單位
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+AMOUNT_PATTERN = re.compile(r"\d+")
+
+
+class StubServer:
+    """以 handle(method, path, body) -> (status, content_type, bytes) 回應的 HTTP 伺服器"""
+
+    def __init__(self, handle, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500, seed=None):
+        self.handle = handle
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _delay_and_fault(self):
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        return failed
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if stub._delay_and_fault():
+                    status, content_type, payload = (
+                        stub.error_status, "application/json",
+                        json.dumps({"error": {"message": "injected failure", "type": "server_error"}}).encode(),
+                    )
+                else:
+                    status, content_type, payload = stub.handle(self.command, self.path, body)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _serve
+            do_POST = _serve
+            do_DELETE = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors}
+
+
+def _input_text(request):
+    """取出 Responses API input 中所有文字，並回報是否含圖片"""
+    texts, has_image = [], False
+    items = request.get("input", [])
+    if isinstance(items, str):
+        return items, False
+    for item in items:
+        content = item.get("content", "")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content:
+            if part.get("type") == "input_image":
+                has_image = True
+            elif "text" in part:
+                texts.append(part["text"])
+    return "\n".join(texts), has_image
+
+
+def _last_text(request):
+    items = request.get("input", [])
+    if isinstance(items, str) or not items:
+        return items if isinstance(items, str) else ""
+    content = items[-1].get("content", "")
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content)
+
+
+_seen_prefixes = set()
+_prefix_lock = threading.Lock()
+
+
+def _cached_tokens(request):
+    """模擬 prompt caching：第一則訊息（固定的指示）先前出現過時，其 token 數視為快取命中"""
+    items = request.get("input", [])
+    if isinstance(items, str) or not items or not isinstance(items[0].get("content"), str):
+        return 0
+    prefix = json.dumps(request.get("tools", []), ensure_ascii=False) + items[0]["content"]
+    tokens = len(prefix) // 2
+    with _prefix_lock:
+        seen = prefix in _seen_prefixes
+        _seen_prefixes.add(prefix)
+    if not seen or tokens < CACHE_MIN_TOKENS:
+        return 0
+    return tokens // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+
+
+def _response_body(model, text, input_tokens, cached_tokens=0):
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": model,
+        "status": "completed",
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "output": [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "status": "completed",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "usage": {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": min(cached_tokens, input_tokens)},
+            "output_tokens": max(1, len(text) // 2),
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + max(1, len(text) // 2),
+        },
+    }
+
+
+def _files_handler(method, path, body):
+    """files API：上傳回傳新的 file id，刪除一律成功"""
+    if method == "POST":
+        payload = {
+            "id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(body),
+            "created_at": int(time.time()), "filename": "image.jpg", "purpose": "vision",
+            "status": "processed",
+        }
+    else:
+        payload = {"id": path.rsplit("/", 1)[1], "object": "file", "deleted": True}
+    return 200, "application/json", json.dumps(payload).encode()
+
+
+def openai_handler(method, path, body):
+    """依請求內容回傳記帳 JSON、收據 JSON、摘要或聊天回覆"""
+    if "/files" in path and method in ("POST", "DELETE"):
+        return _files_handler(method, path, body)
+    if method != "POST" or not path.endswith("/responses"):
+        return 404, "application/json", b'{"error": {"message": "not found"}}'
+    request = json.loads(body or b"{}")
+    text, has_image = _input_text(request)
+    if has_image:
+        reply = json.dumps({"type": "記帳", "transactions": [
+            {"type": "支出", "amount": 250, "item": "超市食品", "category": "飲食",
+             "confidence": 0.9, "year": None, "month": None, "day": None},
+            {"type": "支出", "amount": 70, "item": "洗衣精", "category": "購物",
+             "confidence": 0.9, "year": None, "month": None, "day": None},
+        ]}, ensure_ascii=False)
+    elif ACCOUNTING_MARKER in text:
+        message = _last_text(request)
+        amounts = AMOUNT_PATTERN.findall(message) or ["300"]
+        reply = json.dumps({"type": "記帳", "transactions": [
+            {"type": "支出", "amount": int(amount), "item": "代墊", "category": "社交活動",
+             "confidence": 0.8, "year": None, "month": None, "day": None}
+            for amount in amounts
+        ]}, ensure_ascii=False)
+    elif SUMMARY_MARKER in text:
+        reply = "使用者先前詢問了一些問題。"
+    else:
+        reply = "這是壓力測試的回覆。" * 8
+    payload = _response_body(
+        request.get("model", "stub"), reply, max(1, len(text) // 2), _cached_tokens(request)
+    )
+    return 200, "application/json", json.dumps(payload, ensure_ascii=False).encode()
+
+
+def receipt_jpeg(message_id, size=(1280, 1706)):
+    """依 message_id 產生固定內容的收據照片，不同 id 的感知雜湊不同"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(message_id)
+    image = Image.new("RGB", size, (245, 245, 240))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1, y1 = x0 + rng.randrange(40, 400), y0 + rng.randrange(10, 120)
+        shade = rng.randrange(0, 200)
+        draw.rectangle((x0, y0, x1, y1), fill=(shade, shade, shade))
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+class LineStub:
+    """LINE 回覆與內容下載端點，記錄每個 reply token 的回覆時間"""
+
+    CONTENT_PATTERN = re.compile(r"^/v2/bot/message/([^/]+)/content$")
+
+    def __init__(self):
+        self.replies = {}
+        self._lock = threading.Lock()
+
+    def handle(self, method, path, body):
+        if method == "POST" and path == "/v2/bot/message/reply":
+            request = json.loads(body or b"{}")
+            with self._lock:
+                self.replies[request.get("replyToken")] = time.perf_counter()
+            return 200, "application/json", b'{"sentMessages": [{"id": "1", "quoteToken": "q"}]}'
+        match = self.CONTENT_PATTERN.match(path)
+        if method == "GET" and match:
+            # 每次重新產生，避免替身本身的快取計入記憶體成長
+            return 200, "image/jpeg", receipt_jpeg(match.group(1))
+        return 404, "application/json", b'{"message": "not found"}'
+
+    def reply_time(self, reply_token):
+        with self._lock:
+            return self.replies.get(reply_token)
@@ -0,0 +1,31 @@
+"""gunicorn 設定，於專案根目錄執行：
+    gunicorn -c gunicorn.conf.py "main:create_app()"
+
+master 先匯入重量級模組（preload_app），各 worker fork 後才建立連線、
+執行緒池與背景執行緒。多個 worker 共用 async_webhook 的 SQLite 佇列（以租約取出事件），
+日誌依 PID 分檔，圖表寫入儲存後才回覆，任何一個 worker 都能提供 /images。
+"""
+from script.clients import config
+
+settings = config.get("gunicorn", {})
+bind = settings.get("bind", f"{config.get('host', '0.0.0.0')}:{config.get('port', 5000)}")
+workers = settings.get("workers", 2)
+worker_class = "gthread"
+threads = settings.get("threads", 8)
+timeout = settings.get("timeout", 60)
+preload_app = settings.get("preload_app", True)
+
+
+def on_starting(server):
+    # worker 開始寫入記錄前先補齊 date 與 monthly_totals
+    from script.services import run_migrations
+    run_migrations()
+    if preload_app:
+        from script.services import preload
+        preload()
+
+
+def post_fork(server, worker):
+    import main
+    main.services.worker_processes = workers
+    main.warmup()
@@ -1,137 +1,272 @@
 import json
 import logging
-from flask import Flask, request, abort, send_from_directory
-from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
+import time
+from flask import Blueprint, Flask, Response, request, abort, jsonify
+from linebot.v3.webhook import SignatureValidator
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
     MessagingApi,
     ReplyMessageRequest,
     TextMessage,
 )
-from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent
-from script.gai import IntelligentChatAssistant
-from datetime import datetime
-from script.manay import Accounting
+from linebot.v3.webhooks import (
+    Event,
+    MessageEvent,
+    TextMessageContent,
+    ImageMessageContent,
+)
+from script.scheduler import SchedulerBusy
+from script.clients import registry, config, secret
+from script.router import IntentRouter, CHAT
+from script.webhook_filter import WebhookFilter
+from script.llm_gateway import gateway, deadline_scope, event_deadline, GATEWAY_ERRORS
+from script.prompts import prompts
+from script.metrics import metrics, stage
+from script.services import services
 
+bp = Blueprint("mybot", __name__)
+signature_validator = SignatureValidator(secret["channel_secret"])
+router = IntentRouter()
+webhook_filter = WebhookFilter(enabled=config.get("webhook_prefilter", True))
 
-log_filename = datetime.now().strftime("%Y%m%d_%H%M%S") + ".log"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.FileHandler(
-            "./log/{}".format(log_filename), "w", "utf-8"
-        )
-    ],
-)
+def create_app():
+    """建立 Flask app；重量級模組、連線與背景執行緒在 warmup() 時才建立
+
+    gunicorn 以 post_fork 呼叫 warmup()，其他 WSGI 伺服器則在第一個請求時建立。
+    """
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    app.before_request(warmup)
+    return app
+
+
+def warmup():
+    """每個 worker 執行一次，之後的呼叫立即返回"""
+    services.start(dispatch_event)
 
-app = Flask(__name__)
-config = json.loads(open("config/config.json", "r").read())
-secret = json.loads(open("config/secret.json", "r").read())
-configuration = Configuration(access_token=secret["access_token"])
-handler = WebhookHandler(secret["channel_secret"])
 
+def dispatch_event(destination, event_json):
+    """將已通過簽章驗證的單一事件交給對應的處理函式
 
-@app.route("/callback", methods=["POST"])
+    事件排入排程器後立即返回，回傳其 Future；不需處理時回傳 None。
+    """
+    start = time.thread_time()
+    event = Event.from_dict(event_json)
+    webhook_filter.observe_parse(time.thread_time() - start)
+    if not isinstance(event, MessageEvent):
+        return None
+    if isinstance(event.message, TextMessageContent):
+        return handle_message(event)
+    if isinstance(event.message, ImageMessageContent):
+        return handle_image(event)
+    return None
+
+
+@bp.route("/callback", methods=["POST"])
 def callback():
     # 取得 X-Line-Signature
     signature = request.headers["X-Line-Signature"]
     # 取得請求內容
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        app.logger.info(
+    if config.get("log_request_body", False):
+        logging.info("Request body: " + body)
+    with stage("signature"):
+        valid = signature_validator.validate(body, signature)
+    if not valid:
+        logging.info(
             "Invalid signature. Please check your channel access token/channel secret."
         )
         abort(400)
+    # 先以原始 JSON 丟棄不會回覆的事件（如群組中未提及機器人的訊息），其餘才轉成 SDK 物件
+    with stage("prefilter"):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            abort(400)
+        destination = payload.get("destination")
+        events = webhook_filter.filter(payload.get("events", []))
+    if not events:
+        return "OK"
+    if services.event_queue is not None:
+        # 非同步模式：寫入佇列即回應，由背景 worker 回覆
+        with stage("enqueue"):
+            services.event_queue.put_events(destination, events)
+        return "OK"
+    with stage("webhook_handle"):
+        for event in events:
+            dispatch_event(destination, event)
     return "OK"
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
+def is_self_mentioned(event):
+    mention = getattr(event.message, "mention", None)
+    return bool(mention) and any(
+        getattr(m, "is_self", False) for m in mention.mentionees
+    )
+
+
+def reply_message(reply_message_request):
+    """透過共用的 LINE client 回覆訊息"""
+    line_bot_api = MessagingApi(registry.line())
+    with stage("line_reply"):
+        line_bot_api.reply_message_with_http_info(
+            reply_message_request, _request_timeout=registry.line_timeout()
+        )
+
+
+def reply_text(event, text):
+    reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=text)],
+        )
+    )
+
+
+def run_with_deadline(process, event):
+    """事件內的 LLM 呼叫都必須在 reply token 失效前完成"""
+    with deadline_scope(event_deadline(event)):
+        process(event)
+
+
+def schedule_event(event, process):
+    """依會話排入排程器後立即返回 Future，不佔用呼叫端的執行緒等待
+
+    排程器滿載時直接回覆忙碌訊息並回傳 None。
+    """
+    session_id = services.ai.get_session_id(event)
+    try:
+        return services.scheduler.submit(session_id, event.source.user_id, run_with_deadline, process, event)
+    except SchedulerBusy as e:
+        logging.warning(f"main: 排程器滿載，拒絕會話 {session_id}: {e}")
+        reply_text(event, "目前使用人數眾多，請稍後再試。")
+        return None
+
+
 def handle_message(event):
     source_type = event.source.type
+    if source_type == "user" or (source_type == "group" and is_self_mentioned(event)):
+        return schedule_event(event, process_message)
+    return None
+
+
+def quoted_image(event):
+    """引用先前傳送的圖片時，回傳快取中已處理與上傳的圖片"""
+    message_id = getattr(event.message, "quoted_message_id", None)
+    return services.image_processor.cached(message_id) if message_id else None
+
+
+def process_message(event):
+    # 模型逾時、斷路或 API 錯誤時仍以 reply token 回覆，不讓使用者沒有回應
+    try:
+        answer_message(event)
+    except GATEWAY_ERRORS as e:
+        logging.error(f"main: 處理訊息失敗: {e}")
+        reply_text(event, "目前無法回覆，請稍後再試。")
+
+
+def answer_message(event):
+    source_type = event.source.type
+    image_data = quoted_image(event)
+    if image_data is not None:
+        # 針對先前圖片的追問，直接沿用同一張圖片，不重新下載與上傳
+        services.image_processor.upload(image_data)
+        response_text = services.ai.send_query(event, event.message.text, image_data=image_data)
+        reply_text(event, response_text)
+        return
     match source_type:
         case "user":
-            reply_message_request = ac.parse_message(event)
-            if type(reply_message_request) == ReplyMessageRequest:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.reply_message_with_http_info(reply_message_request)
+            start = time.monotonic()
+            route = router.classify(event.message.text)
+            if route == CHAT:
+                # 一般聊天不需要先經過記帳解析
+                response_text = services.ai.send_query(event, event.message.text)
+                reply_text(event, response_text)
             else:
-                response_text = ai.send_query(event, event.message.text)
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=response_text)],
-                        )
-                    )
-
-                
+                reply_message_request = services.ac.parse_message(event)
+                if type(reply_message_request) == ReplyMessageRequest:
+                    reply_message(reply_message_request)
+                else:
+                    route += "->chat"
+                    response_text = services.ai.send_query(event, event.message.text)
+                    reply_text(event, response_text)
+            router.record(route, time.monotonic() - start)
+
         case "group":
-            mention = getattr(event.message, "mention", None)
-            if mention and any(
-                getattr(m, "is_self", False) for m in mention.mentionees
-            ):
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    response_text = ai.send_query(event, event.message.text)
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=response_text)],
-                        )
-                    )
-
-
-@handler.add(MessageEvent, message=ImageMessageContent)
+            response_text = services.ai.send_query(event, event.message.text)
+            reply_text(event, response_text)
+
+
 def handle_image(event):
     if event.source.type != "user":
-        return  # 僅處理個人對話
+        return None  # 僅處理個人對話
+    return schedule_event(event, process_image)
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
 
-        # 使用AI分析收據圖片並轉換為記帳資訊
-        try:
-            reply_message_request = ac.parse_image(event)
-            if type(reply_message_request) == ReplyMessageRequest:
-                line_bot_api.reply_message_with_http_info(reply_message_request)
-            else:
-                image_data = reply_message_request.get("image")
-                response_text = ai.send_query(event, "",  image_data=image_data)
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=response_text)],
-                    )
-                )
-        except Exception as e:
-            logging.error(f"Error processing image: {e}")
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="無法處理圖片，請稍後再試。")],
-                )
-            )
-
-
-@app.route("/images/<path:image_id>")
-def send_image(image_id):
+def process_image(event):
+    # 使用AI分析收據圖片並轉換為記帳資訊
     try:
-        return send_from_directory("images", image_id)
-    except FileNotFoundError:
+        reply_message_request = services.ac.parse_image(event)
+        if type(reply_message_request) == ReplyMessageRequest:
+            reply_message(reply_message_request)
+        else:
+            # 非收據的圖片改由聊天助理描述，沿用已處理與上傳的同一張圖片
+            image_data = reply_message_request.get("image") or services.image_processor.cached(event.message.id)
+            if image_data is None:
+                reply_text(event, "無法處理圖片，請稍後再試。")
+                return
+            services.image_processor.upload(image_data)
+            response_text = services.ai.send_query(event, "", image_data=image_data)
+            reply_text(event, response_text)
+    except Exception as e:
+        logging.error(f"Error processing image: {e}")
+        reply_text(event, "無法處理圖片，請稍後再試。")
+
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/stats")
+def stats():
+    return jsonify(
+        scheduler=services.scheduler.stats(),
+        routes=router.stats(),
+        receipts=services.ac.receipt_cache.stats(),
+        history=services.ai.compactor.stats(),
+        response_cache=services.ai.response_cache.stats() if services.ai.response_cache else None,
+        images=services.image_processor.cache.stats(),
+        search=services.ai.search_policy.stats(),
+        llm=gateway.stats(),
+        prompts=prompts.stats(),
+        webhook=webhook_filter.stats(),
+    )
+
+
+@bp.route("/images/<path:image_id>")
+def send_image(image_id):
+    """圖片以圖表版本與分類加總的雜湊命名，同一檔名的內容不會變動，可讓客戶端與 CDN 長期快取"""
+    etag = image_id.rsplit(".", 1)[0]
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    services.chart_renderer.wait(image_id)
+    data = services.image_store.get(image_id)
+    if data is None:
         return "Image not found", 404
+    return Response(
+        data,
+        mimetype="image/png",
+        headers={
+            "ETag": f'"{etag}"',
+            "Cache-Control": "public, max-age=31536000, immutable",
+        },
+    )
 
 
 if __name__ == "__main__":
-    ai = IntelligentChatAssistant()
-    ac = Accounting()
+    from script.services import run_migrations
+    run_migrations()
+    app = create_app()
+    warmup()
     app.run(host=config["host"], debug=config["debug"], port=config["port"])
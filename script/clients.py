@@ -0,0 +1,122 @@
+import json
+import logging
+import threading
+import httpx
+from openai import OpenAI
+from pymongo import MongoClient
+from linebot.v3.messaging import ApiClient, Configuration
+
+secret = json.loads(open("config/secret.json", "r").read())
+config = json.loads(open("config/config.json", "r").read())
+
+
+class StreamingApiClient(ApiClient):
+    """_preload_content=False 時不讀取回應內容，ApiResponse.raw_data 為 urllib3 回應，由呼叫端以 stream() 讀取"""
+
+    def request(self, *args, **kwargs):
+        response = super().request(*args, **kwargs)
+        if kwargs.get("_preload_content", True):
+            return response
+        return _UnreadResponse(response)
+
+
+class _UnreadResponse:
+    """SDK 以 .data 組出 ApiResponse.raw_data，改為回傳尚未讀取的 urllib3 回應"""
+
+    def __init__(self, response):
+        self._response = response
+
+    @property
+    def data(self):
+        return self._response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class ClientRegistry:
+    """整個程序共用的 LINE / MongoDB / OpenAI 連線，皆為執行緒安全且具連線池"""
+
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else config.get("clients", {})
+        self._lock = threading.Lock()
+        self._mongo = None
+        self._openai = None
+        self._line = None
+
+    def mongo(self):
+        """共用的 MongoClient（內建連線池）"""
+        if self._mongo is None:
+            with self._lock:
+                if self._mongo is None:
+                    self._mongo = MongoClient(
+                        config.get("mongo_uri", "mongodb://localhost:27017/"),
+                        maxPoolSize=self.settings.get("mongo_pool_size", 20),
+                        connectTimeoutMS=self.settings.get("mongo_connect_timeout_ms", 3000),
+                        socketTimeoutMS=self.settings.get("mongo_socket_timeout_ms", 10000),
+                        serverSelectionTimeoutMS=self.settings.get("mongo_select_timeout_ms", 3000),
+                    )
+                    logging.info("clients: MongoClient initialized")
+        return self._mongo
+
+    def openai(self):
+        """共用的 OpenAI client，底層 httpx 連線保持 keep-alive"""
+        if self._openai is None:
+            with self._lock:
+                if self._openai is None:
+                    http_client = httpx.Client(
+                        limits=httpx.Limits(
+                            max_connections=self.settings.get("openai_pool_size", 20),
+                            max_keepalive_connections=self.settings.get("openai_pool_size", 20),
+                            keepalive_expiry=self.settings.get("keepalive_expiry", 60),
+                        ),
+                        timeout=httpx.Timeout(
+                            self.settings.get("openai_timeout", 60),
+                            connect=self.settings.get("openai_connect_timeout", 5),
+                        ),
+                    )
+                    self._openai = OpenAI(
+                        api_key=secret["openai"],
+                        base_url=self.settings.get("openai_base_url"),
+                        http_client=http_client,
+                        max_retries=self.settings.get("openai_max_retries", 2),
+                    )
+                    logging.info("clients: OpenAI client initialized")
+        return self._openai
+
+    def line(self):
+        """共用的 LINE ApiClient，呼叫端不可用 with 關閉"""
+        if self._line is None:
+            with self._lock:
+                if self._line is None:
+                    configuration = Configuration(
+                        host=self.settings.get("line_host"),
+                        access_token=secret["access_token"],
+                    )
+                    configuration.connection_pool_maxsize = self.settings.get("line_pool_size", 20)
+                    configuration.retries = self.settings.get("line_retries", 2)
+                    self._line = StreamingApiClient(configuration)
+                    logging.info("clients: LINE ApiClient initialized")
+        return self._line
+
+    def line_timeout(self):
+        """LINE API 呼叫的 (connect, read) 逾時秒數，傳給 _request_timeout"""
+        return (
+            self.settings.get("line_connect_timeout", 3),
+            self.settings.get("line_read_timeout", 10),
+        )
+
+    def close(self):
+        with self._lock:
+            if self._mongo is not None:
+                self._mongo.close()
+                self._mongo = None
+            if self._openai is not None:
+                self._openai.close()
+                self._openai = None
+            if self._line is not None:
+                self._line.close()
+                self._line = None
+
+
+registry = ClientRegistry()
@@ -0,0 +1,188 @@
+"""記帳記錄的 CSV 匯入與匯出
+
+匯入時逐列讀取並檢查，以 bulk_write 分批寫入 records 並同步累加 monthly_totals；
+匯出時以游標分批讀取，不會一次載入全部記錄。於專案根目錄執行：
+    python -m script.csv_io import --user USER_ID records.csv
+    python -m script.csv_io export --user USER_ID --start 2025-01-01 --end 2026-01-01 --output out.csv
+"""
+import argparse
+import csv
+import logging
+import math
+import sys
+import uuid
+from datetime import datetime
+from pymongo import InsertOne
+from script.clients import registry
+from script.manay import apply_monthly_totals
+from script.quick_parser import round_amount
+
+COLUMNS = ("date", "type", "amount", "item", "category")
+HEADERS = {"date": "日期", "type": "類型", "amount": "金額", "item": "項目", "category": "分類"}
+HEADER_ALIASES = {
+    "date": "date", "日期": "date",
+    "type": "type", "類型": "type", "收支": "type",
+    "amount": "amount", "金額": "amount",
+    "item": "item", "項目": "item", "名稱": "item",
+    "category": "category", "分類": "category", "類別": "category",
+}
+TYPE_ALIASES = {"收入": "收入", "income": "收入", "支出": "支出", "expense": "支出"}
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d")
+MAX_ERRORS = 20
+
+
+def parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"日期格式錯誤: {value!r}")
+
+
+def parse_amount(value):
+    text = value.strip().replace(",", "").replace("$", "").replace("元", "")
+    try:
+        amount = float(text)
+    except ValueError:
+        raise ValueError(f"金額錯誤: {value!r}")
+    if not math.isfinite(amount) or amount <= 0:
+        raise ValueError(f"金額須為正數: {value!r}")
+    return round_amount(amount)
+
+
+def validate_row(row):
+    """將一列 CSV 轉為記錄欄位，不合格時拋出 ValueError"""
+    record_type = TYPE_ALIASES.get((row.get("type") or "").strip().lower())
+    if record_type is None:
+        raise ValueError(f"類型須為收入或支出: {row.get('type')!r}")
+    date = parse_date(row.get("date") or "")
+    category = (row.get("category") or "").strip() or "其他"
+    return {
+        "type": record_type,
+        "amount": parse_amount(row.get("amount") or ""),
+        "item": (row.get("item") or "").strip() or category,
+        "category": category,
+        "year": date.year,
+        "month": date.month,
+        "day": date.day,
+        "date": date,
+    }
+
+
+def read_rows(lines):
+    """逐列讀取 CSV，標題可為中文或英文，回傳 (行號, 欄位 dict)"""
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [HEADER_ALIASES.get(name.strip().lower()) for name in header]
+    missing = {"date", "type", "amount"} - set(columns)
+    if missing:
+        raise ValueError(f"缺少欄位: {', '.join(sorted(missing))}")
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        yield reader.line_num, {c: v for c, v in zip(columns, row) if c}
+
+
+def _flush(db, records):
+    db.records.bulk_write([InsertOne(record) for record in records], ordered=False)
+    apply_monthly_totals(db, records)
+
+
+def import_csv(db, user_id, lines, batch_size=1000):
+    """匯入 CSV，每 batch_size 筆寫入一次記錄並更新 monthly_totals"""
+    now = datetime.now()
+    import_id = uuid.uuid4().hex
+    stats = {"import_id": import_id, "rows": 0, "imported": 0, "invalid": 0, "errors": []}
+    records = []
+    for line_num, row in read_rows(lines):
+        stats["rows"] += 1
+        try:
+            record = validate_row(row)
+        except ValueError as e:
+            stats["invalid"] += 1
+            if len(stats["errors"]) < MAX_ERRORS:
+                stats["errors"].append(f"第 {line_num} 行: {e}")
+            continue
+        record.update({
+            "user_id": user_id,
+            "source": "csv",
+            "import_id": import_id,
+            "created_at": now,
+            "updated_at": now,
+        })
+        records.append(record)
+        if len(records) >= batch_size:
+            _flush(db, records)
+            stats["imported"] += len(records)
+            records = []
+    if records:
+        _flush(db, records)
+        stats["imported"] += len(records)
+    logging.info(
+        f"csv_io: 匯入 {stats['imported']}/{stats['rows']} 筆，{stats['invalid']} 筆不合格 ({import_id})"
+    )
+    return stats
+
+
+def export_csv(db, user_id, out, start=None, end=None, batch_size=1000):
+    """依交易日期區間 [start, end) 逐批讀取並寫出 CSV，回傳筆數"""
+    query = {"user_id": user_id}
+    if start or end:
+        query["date"] = {}
+        if start:
+            query["date"]["$gte"] = start
+        if end:
+            query["date"]["$lt"] = end
+    projection = {"_id": 0, **{field: 1 for field in COLUMNS}}
+    writer = csv.writer(out)
+    writer.writerow([HEADERS[c] for c in COLUMNS])
+    count = 0
+    for record in db.records.find(query, projection, batch_size=batch_size).sort("date", 1):
+        date = record.get("date")
+        writer.writerow([
+            date.strftime("%Y-%m-%d") if date else "",
+            record.get("type", ""),
+            record.get("amount", ""),
+            record.get("item", ""),
+            record.get("category", ""),
+        ])
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("file", nargs="?", help="匯入的 CSV 檔")
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--start", type=parse_date, default=None)
+    parser.add_argument("--end", type=parse_date, default=None)
+    parser.add_argument("--output", default=None, help="匯出檔，預設輸出到 stdout")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = registry.mongo()["accounting"]
+    if args.command == "import":
+        if not args.file:
+            parser.error("import 需要指定 CSV 檔")
+        with open(args.file, newline="", encoding="utf-8-sig") as f:
+            stats = import_csv(db, args.user, f, args.batch_size)
+        for error in stats["errors"]:
+            print(error)
+        print(f"匯入 {stats['imported']} 筆，{stats['invalid']} 筆不合格，import_id={stats['import_id']}")
+        return
+    out = open(args.output, "w", newline="", encoding="utf-8-sig") if args.output else sys.stdout
+    try:
+        count = export_csv(db, args.user, out, args.start, args.end, args.batch_size)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"匯出 {count} 筆", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
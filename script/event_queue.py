@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+class DurableEventQueue:
+    """以 SQLite 保存 webhook 事件，由背景 worker 依序取出並交給 dispatch
+
+    dispatch 回傳 Future 時（事件已排入排程器），worker 不等待結果，
+    由 Future 完成時的 callback 標記事件完成；同時處理中的事件不超過 max_outstanding。
+    取出的事件帶有租約，多個 gunicorn worker 可共用同一個佇列檔，
+    只有租約到期（取出的程序已終止）的事件才會被重新取出。
+    dispatch 本身失敗（事件尚未交給處理函式）時，間隔 retry_delay 秒並逐次加倍後重試，最多嘗試 max_attempts 次；
+    處理函式已開始執行後的失敗可能已寫入記錄或回覆，不重試以免重複記帳。
+    失敗與過期的事件保留 retention 秒供查閱後刪除。
+    """
+
+    def __init__(self, path, dispatch, workers=4, reply_token_ttl=60, max_outstanding=100, lease=None,
+                 max_attempts=3, retry_delay=2, retention=7 * 86400, prune_interval=3600):
+        self.path = path
+        self.dispatch = dispatch
+        self.workers = workers
+        self.reply_token_ttl = reply_token_ttl
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._next_prune = 0.0
+        # 事件必須在 reply token 失效前處理完，租約只需涵蓋這段時間
+        self.lease = lease if lease is not None else reply_token_ttl * 2
+        self._slots = threading.BoundedSemaphore(max_outstanding)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                destination TEXT,
+                payload TEXT NOT NULL,
+                received_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(events)")}
+        if "lease_until" not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN lease_until REAL")
+        if "retry_at" not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN retry_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_events_status ON events (status, id)")
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    def put_events(self, destination, events):
+        """寫入已解析的事件 dict，回傳寫入筆數"""
+        now = time.time()
+        rows = [
+            (destination, json.dumps(event, ensure_ascii=False), now)
+            for event in events
+        ]
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT INTO events (destination, payload, received_at) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._conn.execute("COMMIT")
+        with self._wakeup:
+            self._wakeup.notify(len(rows))
+        return len(rows)
+
+    def start(self):
+        """啟動 worker；其他程序處理中的事件不受影響，租約到期的事件會再被取出"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM events "
+                "WHERE status = 'processing' AND (lease_until IS NULL OR lease_until < ?)",
+                (time.time(),),
+            ).fetchone()
+        if row[0]:
+            logging.info(f"event_queue: {row[0]} 筆未完成事件的租約已到期，將重新處理")
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"event-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"event_queue: 已啟動 {self.workers} 個 worker")
+
+    def stop(self, timeout=10):
+        """通知 worker 停止，處理中的事件在租約到期後重新排入"""
+        self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def pending_count(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM events WHERE status IN ('pending', 'processing')"
+            ).fetchone()
+        return row[0]
+
+    def _claim(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT id, destination, payload, received_at FROM events "
+                "WHERE (status = 'pending' AND (retry_at IS NULL OR retry_at <= ?)) "
+                "OR (status = 'processing' AND (lease_until IS NULL OR lease_until < ?)) "
+                "ORDER BY id LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE events SET status = 'processing', attempts = attempts + 1, lease_until = ? "
+                    "WHERE id = ?",
+                    (now + self.lease, row[0]),
+                )
+            self._conn.execute("COMMIT")
+        return row
+
+    def _finish(self, event_id, status, error=None, retry=False):
+        with self._lock:
+            if status == "done":
+                self._conn.execute("DELETE FROM events WHERE id = ?", (event_id,))
+                return
+            if retry:
+                # 未達嘗試上限的事件延後重新排入；reply token 過期後會改標為 expired
+                self._conn.execute(
+                    "UPDATE events SET status = CASE WHEN attempts < ? THEN 'pending' ELSE ? END, "
+                    "error = ?, lease_until = NULL, retry_at = ? + ? * (1 << (attempts - 1)) WHERE id = ?",
+                    (self.max_attempts, status, error, time.time(), self.retry_delay, event_id),
+                )
+                return
+            self._conn.execute(
+                "UPDATE events SET status = ?, error = ? WHERE id = ?",
+                (status, error, event_id),
+            )
+
+    def prune(self, now=None):
+        """刪除超過保留期限的失敗與過期事件，回傳刪除筆數"""
+        cutoff = (now or time.time()) - self.retention
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM events WHERE status IN ('failed', 'expired') AND received_at < ?",
+                (cutoff,),
+            )
+        if cursor.rowcount:
+            logging.info(f"event_queue: 已刪除 {cursor.rowcount} 筆失敗或過期事件")
+        return cursor.rowcount
+
+    def _maybe_prune(self):
+        now = time.time()
+        with self._wakeup:
+            if now < self._next_prune:
+                return
+            self._next_prune = now + self.prune_interval
+        try:
+            self.prune(now)
+        except sqlite3.Error as e:
+            logging.error(f"event_queue: 清理事件失敗: {e}")
+
+    def _is_expired(self, event, received_at):
+        """reply token 只在事件發生後短時間內有效"""
+        timestamp = event.get("timestamp")
+        issued_at = timestamp / 1000 if timestamp else received_at
+        return time.time() - issued_at > self.reply_token_ttl
+
+    def _run(self):
+        while not self._stopping:
+            if not self._slots.acquire(timeout=1):
+                continue
+            row = self._claim()
+            if row is None:
+                self._slots.release()
+                self._maybe_prune()
+                with self._wakeup:
+                    self._wakeup.wait(timeout=1)
+                continue
+            self._handle(row)
+
+    def _handle(self, row):
+        """交給 dispatch；回傳 Future 時於完成後才標記結果並釋放名額"""
+        event_id, destination, payload, received_at = row
+        event = json.loads(payload)
+        if "replyToken" in event and self._is_expired(event, received_at):
+            logging.warning(f"event_queue: 事件 {event_id} 的 reply token 已過期，略過")
+            self._settle(event_id, "expired")
+            return
+
+        try:
+            result = self.dispatch(destination, event)
+        except Exception as e:
+            logging.error(f"event_queue: 事件 {event_id} 分派失敗: {e}")
+            self._settle(event_id, "failed", str(e), retry=True)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self._on_done(event_id, future))
+        else:
+            self._settle(event_id, "done")
+
+    def _on_done(self, event_id, future):
+        error = future.exception()
+        if error is None:
+            self._settle(event_id, "done")
+        else:
+            logging.error(f"event_queue: 事件 {event_id} 處理失敗: {error}")
+            self._settle(event_id, "failed", str(error))
+
+    def _settle(self, event_id, status, error=None, retry=False):
+        try:
+            self._finish(event_id, status, error, retry)
+        finally:
+            self._slots.release()
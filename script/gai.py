@@ -1,34 +1,45 @@
-from openai import OpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import ChatOpenAI
-from googlesearch import search
-import json
+import time
 from .mongo_history import MongoHistoryManager
+from .history_compactor import HistoryCompactor
+from .llm_gateway import gateway
+from .clients import config
+from .metrics import stage
+from .response_cache import ResponseCache
+from .prompts import prompts
+from .search_policy import SearchPolicy
 import logging
 
 
-MODEL = json.loads(open("config/config.json", "r").read())["model"]
-PROMPT = open("prompt/prompt.txt", "r").read()
-secret = json.loads(open("config/secret.json", "r").read())
+MODEL = config["model"]
 
 class IntelligentChatAssistant:
     def __init__(self):
-        self.client = OpenAI(
-            api_key=secret["openai"]
-        )
-        self.prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", PROMPT),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("user", "{input}"),
-            ]
+        self.history_manager = MongoHistoryManager()
+        self.compactor = HistoryCompactor(
+            self.history_manager,
+            config.get("summary_model", MODEL),
+            budget=config.get("history_token_budget", 2000),
         )
-        self.llm = ChatOpenAI(
-            model=MODEL, api_key=secret["openai"]
+        self.response_cache = self._create_response_cache(config.get("response_cache", {}))
+        search_settings = config.get("search_policy", {})
+        self.search_policy = SearchPolicy(
+            enabled=search_settings.get("enabled", True),
+            default=search_settings.get("default", False),
+            classifier_model=search_settings.get("classifier_model"),
         )
-        self.history_manager = MongoHistoryManager()
         logging.info("gai: class initialized")
 
+    def _create_response_cache(self, settings):
+        if not settings.get("enabled", True):
+            return None
+        return ResponseCache(
+            lambda: f"{MODEL}:{prompts.version('prompt')}",
+            ttl=settings.get("ttl", 6 * 3600),
+            search_ttl=settings.get("search_ttl", 1800),
+            max_bytes=settings.get("max_bytes", 8 * 1024 * 1024),
+            collection=self.history_manager.db["response_cache"] if settings.get("shared", False) else None,
+        )
+
     def _get_session_id(self, source_type, user_id, group_id=None, room_id=None):
         """根據來源類型生成會話ID"""
         if source_type == "user":
@@ -39,61 +50,94 @@ class IntelligentChatAssistant:
             return f"room_{room_id}_user_{user_id}"
         return f"default_{user_id}"  # 預設情況
 
-    def send_query(self, event, user_input, image_data=None):
-        """處理用戶查詢，整合MongoDB歷史記錄"""
-        # 生成會話ID
+    def get_session_id(self, event):
+        """由 LINE 事件來源取得會話ID"""
         source_type = event.source.type
         user_id = event.source.user_id
         group_id = getattr(event.source, "group_id", None)
         room_id = getattr(event.source, "room_id", None)
+        return self._get_session_id(source_type, user_id, group_id, room_id)
 
-        session_id = self._get_session_id(source_type, user_id, group_id, room_id)
+    def send_query(self, event, user_input, image_data=None):
+        """處理用戶查詢，整合MongoDB歷史記錄"""
+        # 生成會話ID
+        session_id = self.get_session_id(event)
 
-        # 獲取歷史記錄
-        chat_history = self.history_manager.get_history(session_id)
-        history_messages = self.history_manager.get_messages_as_dict(session_id)
-        messages = [{"role": "system", "content": PROMPT}]
+        # 與上下文無關的重複問題直接沿用先前的回覆
+        context_free = False
+        if not image_data and self.response_cache is not None:
+            cached = self.response_cache.get(user_input)
+            if cached is not None:
+                self.history_manager.append_turn(session_id, user_input, cached)
+                return cached
+            context_free = self.response_cache.cacheable(user_input)
+
+        if context_free:
+            # 可快取的問題不附帶歷史呼叫模型，回覆不含此使用者的上下文，才能提供給其他人
+            history_messages, raw_tokens, history_tokens = [], 0, 0
+        else:
+            # 獲取歷史記錄（較舊的對話以摘要取代，控制在 token 預算內）
+            with stage("history_build"):
+                history_messages, raw_tokens, history_tokens = self.compactor.build(session_id)
         
-        # 圖
+        # 圖（已上傳時以 file_id 引用，附帶的文字為針對圖片的提問）
         if image_data:
-            messages = [{"role": "system", "content": PROMPT}]
+            content = [image_data.input_content()]
+            if user_input:
+                content.insert(0, {"type": "input_text", "text": user_input})
+            messages = [{"role": "system", "content": prompts.text("prompt")}]
             messages += history_messages
-            messages.append({
-                "role": "user",
-                "content": [
-                    {
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{image_data}",
-                        "detail": "high"  # 可選參數，控制圖片解析度
-                    }
-                ]
-            })
-            response = self.client.responses.create(
-                model=MODEL,
-                input=messages,
-                tools=[{"type": "web_search_preview"}]
-            ).output_text
+            messages.append({"role": "user", "content": content})
+            # 單純描述圖片不需要搜尋，只有附帶的提問需要時才附加工具
+            use_search, reason = self.search_policy.decide(user_input)
+            response = self._create(messages, raw_tokens, history_tokens, use_search, reason).output_text
             # 儲存圖片分析對話
-            chat_history.add_user_message("[圖片]")
-            chat_history.add_ai_message(response)
+            self.history_manager.append_turn(session_id, f"[圖片] {user_input}".rstrip(), response)
             return response
 
         
         
         # 文字訊息
-        response = self.client.responses.create(
-            model=MODEL,
-            input=[
-                {"role": "system", "content": PROMPT},
+        use_search, reason = self.search_policy.decide(user_input)
+        result = self._create(
+            [
+                {"role": "system", "content": prompts.text("prompt")},
                 *history_messages,
                 {"role": "user", "content": user_input},
             ],
-            tools=[{"type": "web_search_preview"}]
-        ).output_text
+            raw_tokens,
+            history_tokens,
+            use_search,
+            reason,
+        )
+        response = result.output_text
+        if context_free:
+            # 用過網路搜尋的回覆時效性較高，TTL 較短
+            used_search = any(getattr(item, "type", None) == "web_search_call" for item in result.output)
+            self.response_cache.put(user_input, response, used_search=used_search)
 
-        
-        # 更新對話歷史到MongoDB
-        chat_history.add_user_message(user_input)
-        chat_history.add_ai_message(response)
+        # 更新對話歷史（背景批次寫入MongoDB）
+        self.history_manager.append_turn(session_id, user_input, response)
 
         return response
+
+    def _create(self, messages, raw_tokens, history_tokens, use_search=True, reason=""):
+        """呼叫模型並記錄歷史 token 數與延遲，回傳 Response"""
+        kwargs = {"tools": [{"type": "web_search_preview"}]} if use_search else {}
+        start = time.monotonic()
+        with stage("chat_llm_search" if use_search else "chat_llm"):
+            response = gateway.create(
+                model=MODEL,
+                input=messages,
+                prompt_name="prompt",
+                **kwargs,
+            )
+        latency = time.monotonic() - start
+        self.compactor.record(raw_tokens, history_tokens, latency)
+        usage = getattr(response, "usage", None)
+        logging.info(
+            f"gai: 搜尋工具 {'附加' if use_search else '不附加'} ({reason})，"
+            f"歷史 token {raw_tokens} -> {history_tokens}，"
+            f"輸入 token {getattr(usage, 'input_tokens', '?')}，延遲 {latency:.2f}s"
+        )
+        return response
@@ -1,32 +1,110 @@
-import matplotlib.pyplot as plt
+import hashlib
+import io
+import json
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from script.metrics import stage
 
+CHART_VERSION = 1  # 圖表樣式變更時遞增，避免沿用舊快取
+_font_lock = threading.Lock()
+_font_ready = False
+
+
+def _setup_fonts():
+    """字型設定只做一次"""
+    global _font_ready
+    with _font_lock:
+        if not _font_ready:
+            matplotlib.rcParams["font.family"] = "AR PL UMing CN"
+            matplotlib.rcParams["axes.unicode_minus"] = False
+            _font_ready = True
+
+
+class ChartRenderer:
+    """在背景執行緒池以 Agg 繪製圓餅圖，相同資料直接沿用既有 PNG
+
+    檔名由 CHART_VERSION 與分類加總雜湊而成，同一檔名的內容永遠不變。
+    """
+
+    def __init__(self, store, workers=2):
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chart")
+        self._lock = threading.Lock()
+        self._inflight = {}
+        _setup_fonts()
 
-class GenPieChart:
     @staticmethod
-    def generate_pie_chart(records):
-        plt.rcParams["font.family"] = "AR PL UMing CN"
-        plt.rcParams["axes.unicode_minus"] = False
-        user_id = records[0]["user_id"] if records else None
-        category_sums = dict()
-        for record in records:
-            if record["type"] == "收入":
-                continue
-            category = record["category"]
-            amount = record["amount"]
-            category_sums[category] = category_sums.get(category, 0) + amount
-
-        labels = list(category_sums.keys())
-        sizes = list(category_sums.values())
-
-        plt.figure(figsize=(8, 8))
-        plt.pie(
-            sizes,
-            labels=labels,
-            autopct=lambda pct: f'{pct:.1f}%\n({int(pct/100.*sum(sizes))}元)',
-            startangle=140,
-            textprops={"fontsize": 16}
+    def cache_key(category_sums):
+        payload = json.dumps(
+            [CHART_VERSION, sorted(category_sums.items())], ensure_ascii=False
         )
-        plt.title("支出分類佔比", fontsize=20)
-        plt.axis("equal")
-        plt.savefig(f"images/{user_id}.png")
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def render_async(self, category_sums):
+        """排入繪圖工作並立即回傳 (檔名, Future)"""
+        filename = f"{self.cache_key(category_sums)}.png"
+        with self._lock:
+            future = self._inflight.get(filename)
+            if future is not None:
+                return filename, future
+            # 既有圖片也要更新時間，剛回覆的圖片才不會被回收
+            if self.store.touch(filename):
+                future = Future()
+                future.set_result(filename)
+                return filename, future
+            future = self._executor.submit(self._render, dict(category_sums), filename)
+            self._inflight[filename] = future
+        return filename, future
+
+    def render(self, category_sums, timeout=None):
+        filename, future = self.render_async(category_sums)
+        return future.result(timeout)
+
+    def wait(self, filename, timeout=10):
+        """若圖片仍在繪製中則等待完成，供圖片路由使用"""
+        with self._lock:
+            future = self._inflight.get(filename)
+        if future is not None:
+            future.result(timeout)
+
+    def _render(self, category_sums, filename):
+        with stage("chart_render"):
+            return self._render_unlocked(category_sums, filename)
+
+    def _render_unlocked(self, category_sums, filename):
+        try:
+            labels = list(category_sums.keys())
+            sizes = list(category_sums.values())
+            total = sum(sizes)
+
+            figure = Figure(figsize=(8, 8))
+            FigureCanvasAgg(figure)
+            ax = figure.add_subplot()
+            if sizes:
+                ax.pie(
+                    sizes,
+                    labels=labels,
+                    autopct=lambda pct: f'{pct:.1f}%\n({int(pct/100.*total)}元)',
+                    startangle=140,
+                    textprops={"fontsize": 16}
+                )
+            else:
+                ax.text(0.5, 0.5, "沒有支出記錄", ha="center", va="center", fontsize=20)
+            ax.set_title("支出分類佔比", fontsize=20)
+            ax.axis("equal")
+
+            buffer = io.BytesIO()
+            figure.savefig(buffer, format="png")
+            figure.clear()
+            self.store.put(filename, buffer.getvalue())
+            return filename
+        except Exception as e:
+            logging.error(f"generate_graph: 繪製圖表失敗: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(filename, None)
@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tiktoken
+from script.llm_gateway import gateway
+from script.prompts import prompts
+
+
+def _fingerprint(message):
+    return hashlib.sha1(f"{message['role']}:{message['content']}".encode("utf-8")).hexdigest()
+
+
+class TokenCounter:
+    """以 tiktoken 在本機計算 token 數"""
+
+    def __init__(self, model):
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message):
+        content = message["content"]
+        if not isinstance(content, str):
+            return 4
+        return self.count(content) + 4  # 每則訊息的角色與格式開銷
+
+
+class HistoryCompactor:
+    """在 token 預算內保留最近的對話原文，較舊的對話併入每個會話的滾動摘要
+
+    摘要在背景更新，回覆時只讀取目前已存在的摘要，不會多等一次 LLM 呼叫。
+    """
+
+    def __init__(self, history_manager, model, budget=2000, max_cached=5000):
+        self.history_manager = history_manager
+        self.model = model
+        self.budget = budget
+        self.counter = TokenCounter(model)
+        self.collection = history_manager.db['chat_summaries']
+        try:
+            self.collection.create_index("session_id", unique=True)
+        except Exception as e:
+            logging.error(f"history_compactor: 建立索引失敗: {e}")
+        self.max_cached = max_cached
+        self._summaries = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+        self._stats = {"requests": 0, "raw_tokens": 0, "compacted_tokens": 0,
+                       "latency_sum": 0.0, "summaries": 0}
+
+    def build(self, session_id):
+        """回傳 (歷史訊息, 原始 token 數, 壓縮後 token 數)"""
+        history = self.history_manager.get_messages_as_dict(session_id)
+        sizes = [self.counter.count_message(m) for m in history]
+        raw_tokens = sum(sizes)
+
+        kept = 0
+        used = 0
+        for size in reversed(sizes):
+            if used + size > self.budget:
+                break
+            used += size
+            kept += 1
+        # 保留的部分從使用者訊息開始，避免開頭是沒有提問的 AI 回覆
+        while kept and history[len(history) - kept]["role"] != "user":
+            used -= sizes[len(history) - kept]
+            kept -= 1
+        recent = history[len(history) - kept:]
+        overflow = history[:len(history) - kept]
+
+        messages = []
+        summary = self._get_summary(session_id)
+        if overflow:
+            self._schedule(session_id, overflow, summary)
+        if summary and summary.get("summary"):
+            text = f"先前對話摘要：\n{summary['summary']}"
+            messages.append({"role": "system", "content": text})
+            used += self.counter.count(text)
+        messages += recent
+        return messages, raw_tokens, used
+
+    def record(self, raw_tokens, compacted_tokens, latency):
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["raw_tokens"] += raw_tokens
+            self._stats["compacted_tokens"] += compacted_tokens
+            self._stats["latency_sum"] += latency
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        requests = stats.pop("requests")
+        latency_sum = stats.pop("latency_sum")
+        stats["requests"] = requests
+        stats["raw_tokens_avg"] = stats.pop("raw_tokens") / requests if requests else 0
+        stats["compacted_tokens_avg"] = stats.pop("compacted_tokens") / requests if requests else 0
+        stats["latency_avg"] = latency_sum / requests if requests else 0
+        return stats
+
+    def _get_summary(self, session_id):
+        with self._lock:
+            if session_id in self._summaries:
+                self._summaries.move_to_end(session_id)
+                return self._summaries[session_id]
+        summary = self.collection.find_one({"session_id": session_id}, {"_id": 0})
+        self._remember(session_id, summary)
+        return summary
+
+    def _remember(self, session_id, summary):
+        with self._lock:
+            self._summaries[session_id] = summary
+            self._summaries.move_to_end(session_id)
+            while len(self._summaries) > self.max_cached:
+                self._summaries.popitem(last=False)
+
+    def _schedule(self, session_id, overflow, summary):
+        """找出尚未併入摘要的訊息，交給背景執行緒處理"""
+        last = summary.get("last_fingerprint") if summary else None
+        fingerprints = [_fingerprint(m) for m in overflow]
+        if last in fingerprints:
+            new_messages = overflow[fingerprints.index(last) + 1:]
+        else:
+            new_messages = overflow
+        if not new_messages:
+            return
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._executor.submit(
+            self._summarize, session_id, summary, new_messages, fingerprints[-1]
+        )
+
+    def _summarize(self, session_id, summary, new_messages, last_fingerprint):
+        try:
+            transcript = "\n".join(
+                f"{'使用者' if m['role'] == 'user' else '助手'}：{m['content']}"
+                for m in new_messages
+                if isinstance(m["content"], str)
+            )
+            previous = summary.get("summary", "") if summary else ""
+            text = gateway.create(
+                model=self.model,
+                input=[
+                    {"role": "system", "content": prompts.text("summary_prompt")},
+                    {"role": "user", "content": f"既有摘要：\n{previous or '（無）'}\n\n新增對話：\n{transcript}"},
+                ],
+                prompt_name="summary_prompt",
+            ).output_text
+            updated = {
+                "session_id": session_id,
+                "summary": text.strip(),
+                "last_fingerprint": last_fingerprint,
+            }
+            self.collection.replace_one({"session_id": session_id}, updated, upsert=True)
+            self._remember(session_id, updated)
+            with self._lock:
+                self._stats["summaries"] += 1
+        except Exception as e:
+            logging.error(f"history_compactor: 更新摘要失敗 {session_id}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
@@ -1,19 +1,41 @@
-from linebot.v3.messaging import ApiClient, MessagingApiBlob
+from linebot.v3.messaging import MessagingApiBlob
+from script.clients import registry, config
 import base64
 import logging
-import imghdr  
-from PIL import Image  
-import pyheif  
+import imghdr
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+import pyheif
 import io
+from script.receipt_cache import dhash
+from script.llm_gateway import gateway
+from script.metrics import metrics, stage
+
+# ISO BMFF 中屬於 HEIF/HEIC 的 major brand
+HEIF_BRANDS = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'hevm', b'hevs', b'mif1', b'msf1'}
+IMAGE_CACHE_EVENTS = metrics.counter(
+    "mybot_image_cache_total", "Processed image cache lookups and evictions", labels=("result",)
+)
+IMAGE_UPLOADS = metrics.counter(
+    "mybot_image_uploads_total", "Images uploaded to the OpenAI files API", labels=("result",)
+)
+
+
+class ImageTooLarge(Exception):
+    """圖片超過下載大小上限"""
 
 
 class HeicConverter:
     @staticmethod
-    def heic_to_jpeg(heic_data: bytes) -> bytes:
-        """將 HEIC 轉為 JPEG 格式"""
+    def heic_to_image(heic_data: bytes) -> Image.Image:
+        """將 HEIC 解碼為 PIL 影像"""
         try:
             heif_file = pyheif.read_heif(heic_data)
-            image = Image.frombytes(
+            return Image.frombytes(
                 heif_file.mode,
                 heif_file.size,
                 heif_file.data,
@@ -21,55 +43,328 @@ class HeicConverter:
                 heif_file.mode,
                 heif_file.stride,
             )
-            buf = io.BytesIO()
-            image.save(buf, format="JPEG", quality=85)
-            return buf.getvalue()
         except Exception as e:
             logging.error(f"HEIC 轉換失敗: {str(e)}")
             raise
 
+    @staticmethod
+    def heic_to_jpeg(heic_data: bytes) -> bytes:
+        """將 HEIC 轉為 JPEG 格式"""
+        image = HeicConverter.heic_to_image(heic_data)
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=85)
+        return buf.getvalue()
+
+
+def vision_tokens(width, height, detail):
+    """依 OpenAI 的計算方式估算圖片輸入 token 數"""
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+class ProcessedImage:
+    """縮圖並重新編碼後、準備送給視覺模型的圖片"""
+
+    def __init__(self, data, width, height, detail, original_bytes, original_size, phash=None):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.detail = detail
+        self.original_bytes = original_bytes
+        self.original_size = original_size
+        self.phash = phash
+        self.file_id = None
+        self.file_expires_at = None
+
+    @property
+    def base64(self):
+        return base64.b64encode(self.data).decode('utf-8')
+
+    @property
+    def data_url(self):
+        return f"data:image/jpeg;base64,{self.base64}"
+
+    def input_content(self):
+        """Responses API 的 input_image 內容，已上傳時只傳 file_id"""
+        if self.file_id:
+            return {"type": "input_image", "file_id": self.file_id, "detail": self.detail}
+        return {"type": "input_image", "image_url": self.data_url, "detail": self.detail}
+
+
+class ImageUploader:
+    """將圖片上傳到 OpenAI files API，之後的呼叫只以 file_id 引用
+
+    上傳失敗時保留 data URL，呼叫端不受影響。上傳的逾時受事件最後期限限制，
+    並保留 reserve 秒給之後的模型呼叫，剩餘時間不足時直接使用 data URL。檔案設定 expires_after，
+    即使程序重啟、沒有機會刪除，也會在 file_ttl 秒後由 OpenAI 自動清除；
+    快取中的圖片接近到期時重新上傳。
+    """
+
+    # OpenAI 允許的到期時間為 1 小時至 30 天
+    MIN_FILE_TTL = 3600
+    MAX_FILE_TTL = 30 * 86400
+    REFRESH_MARGIN = 300
+
+    MIN_UPLOAD_TIME = 1
+
+    def __init__(self, enabled=True, file_ttl=86400, timeout=10, reserve=20):
+        self.enabled = enabled
+        self.file_ttl = min(max(file_ttl, self.MIN_FILE_TTL), self.MAX_FILE_TTL)
+        self.timeout = timeout
+        self.reserve = reserve
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def upload(self, image):
+        """需要時才上傳（已上傳且未接近到期時直接回傳 file_id）"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        if image.file_id and now < image.file_expires_at - self.REFRESH_MARGIN:
+            return image.file_id
+        timeout = min(self.timeout, gateway.remaining() - self.reserve)
+        if timeout < self.MIN_UPLOAD_TIME:
+            IMAGE_UPLOADS.inc(result="skipped")
+            logging.info("image_processor: 剩餘時間不足，不上傳圖片，改用 data URL")
+            return image.file_id
+        try:
+            with stage("image_upload"):
+                client = registry.openai().with_options(timeout=timeout, max_retries=0)
+                uploaded = client.files.create(
+                    file=("image.jpg", image.data, "image/jpeg"),
+                    purpose="vision",
+                    extra_body={"expires_after": {"anchor": "created_at", "seconds": self.file_ttl}},
+                )
+            image.file_id = uploaded.id
+            image.file_expires_at = now + self.file_ttl
+            IMAGE_UPLOADS.inc(result="ok")
+        except Exception as e:
+            IMAGE_UPLOADS.inc(result="failed")
+            logging.warning(f"image_processor: 上傳圖片失敗，改用 data URL: {e}")
+        return image.file_id
+
+    def delete(self, file_id):
+        """在背景刪除不再使用的檔案"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-delete")
+        self._executor.submit(self._delete, file_id)
+
+    @staticmethod
+    def _delete(file_id):
+        try:
+            registry.openai().files.delete(file_id)
+        except Exception as e:
+            logging.warning(f"image_processor: 刪除檔案 {file_id} 失敗: {e}")
+
+
+class ProcessedImageCache:
+    """依 LINE message id 保存處理後（與已上傳）的圖片
+
+    收據解析、聊天備援與之後引用同一張圖片的追問都直接沿用，不再下載與上傳。
+    依位元組數上限與最後一次使用後的存活時間淘汰，淘汰的圖片交給 on_evict 刪除已上傳的檔案。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600, on_evict=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, message_id):
+        now = time.time()
+        with self._lock:
+            evicted = self._expire(now)
+            entry = self._entries.get(message_id)
+            if entry is not None:
+                # 存活時間自最後一次使用起算，LRU 順序即為到期順序
+                self._entries[message_id] = (entry[0], now + self.ttl, entry[2])
+                self._entries.move_to_end(message_id)
+            result = "hits" if entry is not None else "misses"
+            self._stats[result] += 1
+        self._evicted(evicted)
+        IMAGE_CACHE_EVENTS.inc(result=result)
+        return entry[0] if entry is not None else None
+
+    def put(self, message_id, image):
+        size = len(image.data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            evicted = self._expire(time.time())
+            if message_id in self._entries:
+                self._drop(message_id)
+            self._entries[message_id] = (image, time.time() + self.ttl, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                evicted.append(self._drop(next(iter(self._entries))))
+                self._stats["evictions"] += 1
+        self._evicted(evicted)
+
+    def _expire(self, now):
+        """移除過期項目（呼叫端持有鎖），回傳被移除的圖片"""
+        expired = []
+        while self._entries:
+            message_id, (_, expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            expired.append(self._drop(message_id))
+            self._stats["expired"] += 1
+        return expired
+
+    def _drop(self, message_id):
+        image, _, size = self._entries.pop(message_id)
+        self._bytes -= size
+        return image
+
+    def _evicted(self, images):
+        for image in images:
+            IMAGE_CACHE_EVENTS.inc(result="evictions")
+            if self.on_evict is not None and image.file_id:
+                self.on_evict(image.file_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+
 
 class ImageProcessor:
-    def __init__(self, config):
-        self.config = config
+    def __init__(self):
         logging.basicConfig(level=logging.INFO)
         self.supported_formats = {'jpeg', 'png', 'gif', 'heic'}
-    
+        settings = config.get("image", {})
+        self.max_download_bytes = settings.get("max_download_bytes", 10 * 1024 * 1024)
+        # 超過 2048 長邊或 768 短邊的部分，模型端本來就會縮掉
+        self.max_long_side = settings.get("max_long_side", 2048)
+        self.max_short_side = settings.get("max_short_side", 768)
+        self.jpeg_quality = settings.get("jpeg_quality", 80)
+        self.detail = settings.get("detail", "auto")
+        self.uploader = ImageUploader(
+            enabled=settings.get("upload", True),
+            file_ttl=settings.get("file_ttl", 86400),
+            timeout=settings.get("upload_timeout", 10),
+            reserve=settings.get("upload_reserve", 20),
+        )
+        self.cache = ProcessedImageCache(
+            max_bytes=settings.get("cache_max_bytes", 64 * 1024 * 1024),
+            ttl=settings.get("cache_ttl", 3600),
+            on_evict=self.uploader.delete,
+        )
+
     def _detect_image_type(self, image_data: bytes) -> str:
         """強化型圖片格式檢測"""
-        # 優先檢查 HEIC (imghdr 無法辨識 HEIC)
-        if image_data.startswith(b'\x00\x00\x00\x20ftypheic'):
+        # 優先檢查 HEIC/HEIF (imghdr 無法辨識)，ftyp box 後接 major brand
+        if image_data[4:8] == b'ftyp' and image_data[8:12] in HEIF_BRANDS:
             return 'heic'
         detected = imghdr.what(None, h=image_data)
         return detected if detected else 'unknown'
-    
-    def download_image(self, message_id, convert_heic=True) -> str:
-        """支援 HEIC 的自動轉換方法"""
+
+    def _stream_content(self, message_id) -> bytes:
+        """以 MessagingApiBlob 串流下載訊息內容，超過大小上限立即中止"""
+        response = MessagingApiBlob(registry.line()).get_message_content_with_http_info(
+            message_id, _preload_content=False, _request_timeout=registry.line_timeout()
+        )
+        stream = response.raw_data
+        try:
+            length = int((response.headers or {}).get("Content-Length") or 0)
+            if length > self.max_download_bytes:
+                raise ImageTooLarge(f"{length} bytes")
+            buf = bytearray()
+            for chunk in stream.stream(64 * 1024):
+                buf.extend(chunk)
+                if len(buf) > self.max_download_bytes:
+                    raise ImageTooLarge(f"> {self.max_download_bytes} bytes")
+            return bytes(buf)
+        finally:
+            stream.release_conn()
+
+    def _choose_detail(self, width, height):
+        if self.detail != "auto":
+            return self.detail
+        # 512x512 以內 low 與 high 看到的內容相同，但 token 只要 85
+        return "low" if max(width, height) <= 512 else "high"
+
+    def process(self, raw_data: bytes, img_type: str) -> ProcessedImage:
+        """解碼、縮圖並以調整過的品質重新編碼為 JPEG"""
+        oriented = True
+        if img_type == 'heic':
+            image = HeicConverter.heic_to_image(raw_data)
+        else:
+            image = Image.open(io.BytesIO(raw_data))
+            oriented = image.getexif().get(0x0112, 1) == 1
+            image = ImageOps.exif_transpose(image)
+        original_size = image.size
+
+        width, height = image.size
+        scale = min(
+            1.0,
+            self.max_long_side / max(width, height),
+            self.max_short_side / min(width, height),
+        )
+        if scale < 1.0:
+            image = image.resize(
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                Image.LANCZOS,
+            )
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        if scale == 1.0 and img_type == 'jpeg' and oriented:
+            data = raw_data  # 不需縮圖的 JPEG 直接沿用，避免重複壓縮
+        else:
+            buf = io.BytesIO()
+            image.save(buf, format="JPEG", quality=self.jpeg_quality, optimize=True)
+            data = buf.getvalue()
+
+        processed = ProcessedImage(
+            data, image.size[0], image.size[1],
+            self._choose_detail(*image.size), len(raw_data), original_size,
+            phash=dhash(image),
+        )
+        tokens_before = vision_tokens(*original_size, "high")
+        tokens_after = vision_tokens(processed.width, processed.height, processed.detail)
+        logging.info(
+            f"image_processor: {img_type} {original_size[0]}x{original_size[1]} -> "
+            f"{processed.width}x{processed.height} ({processed.detail}), "
+            f"bytes {len(raw_data)} -> {len(data)} (省 {len(raw_data) - len(data)}), "
+            f"tokens {tokens_before} -> {tokens_after} (省 {tokens_before - tokens_after})"
+        )
+        return processed
+
+    def cached(self, message_id):
+        """已處理過的圖片，不在快取中時回傳 None（不會下載）"""
+        return self.cache.get(message_id)
+
+    def upload(self, image):
+        """送給模型前呼叫：上傳一次，之後以 file_id 引用"""
+        return self.uploader.upload(image)
+
+    def download_image(self, message_id) -> ProcessedImage:
+        """下載並處理圖片，支援 HEIC/HEIF 自動轉換；同一則訊息只處理一次
+
+        不會上傳，呼叫端確定要送給模型時再呼叫 upload()。
+        """
+        cached = self.cache.get(message_id)
+        if cached is not None:
+            return cached
         try:
-            with ApiClient(self.config) as api_client:
-                blob_api = MessagingApiBlob(api_client)
-                content = blob_api.get_message_content(message_id)
-                
-                file_content = bytearray()
-                for chunk in content:
-                    if isinstance(chunk, (bytes, bytearray)):
-                        file_content.extend(chunk)
-                    elif isinstance(chunk, int):
-                        file_content.append(chunk)
-                    else:
-                        logging.warning(f"忽略無效數據類型: {type(chunk)}")
-                
-                raw_data = bytes(file_content)
-                img_type = self._detect_image_type(raw_data)
-                logging.info(f"received {img_type} image")
-                # HEIC 轉換處理
-                if img_type == 'heic' and convert_heic:
-                    jpeg_data = HeicConverter.heic_to_jpeg(raw_data)
-                    return base64.b64encode(jpeg_data).decode('utf-8')
-                
-                # 非 HEIC 直接返回
-                return base64.b64encode(raw_data).decode('utf-8')
+            with stage("image_download"):
+                raw_data = self._stream_content(message_id)
+            img_type = self._detect_image_type(raw_data)
+            logging.info(f"received {img_type} image")
+            with stage("image_process"):
+                processed = self.process(raw_data, img_type)
 
         except Exception as e:
             logging.error(f"圖片處理失敗: {str(e)}")
             return None
+        self.cache.put(message_id, processed)
+        return processed
@@ -0,0 +1,169 @@
+import gridfs
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+class LocalImageStore:
+    """存放於本機目錄，僅適用單一節點"""
+
+    shared = False
+
+    def __init__(self, directory="images"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, os.path.basename(name))
+
+    def touch(self, name):
+        """更新修改時間，延後被回收；檔案不存在時回傳 False"""
+        try:
+            os.utime(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, name, data):
+        if self.touch(name):
+            return
+        path = self._path(name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, name):
+        try:
+            with open(self._path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def gc(self, max_age):
+        cutoff = time.time() - max_age
+        removed = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+
+class GridFSImageStore:
+    """存放於 MongoDB GridFS，多個節點可共用"""
+
+    shared = True
+
+    def __init__(self, db, bucket_name="chart_images"):
+        self.bucket = gridfs.GridFSBucket(db, bucket_name=bucket_name)
+        self.files = db[f"{bucket_name}.files"]
+        try:
+            self.files.create_index("filename")
+        except Exception as e:
+            logging.error(f"image_store: 建立索引失敗: {e}")
+
+    def touch(self, name):
+        """更新 uploadDate，延後被回收；檔案不存在時回傳 False"""
+        result = self.files.update_many({"filename": name}, {"$set": {"uploadDate": datetime.utcnow()}})
+        return result.matched_count > 0
+
+    def put(self, name, data):
+        if self.touch(name):
+            return
+        self.bucket.upload_from_stream(name, data)
+
+    def get(self, name):
+        try:
+            return self.bucket.open_download_stream_by_name(name).read()
+        except gridfs.errors.NoFile:
+            return None
+
+    def gc(self, max_age):
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+        removed = 0
+        for doc in self.files.find({"uploadDate": {"$lt": cutoff}}, {"_id": 1}):
+            self.bucket.delete(doc["_id"])
+            removed += 1
+        return removed
+
+
+class CachedImageStore:
+    """在後端儲存前加上記憶體 LRU，熱門圖片不必每次讀取"""
+
+    def __init__(self, backend, max_bytes=16 * 1024 * 1024):
+        self.backend = backend
+        self.shared = backend.shared
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def touch(self, name):
+        # 記憶體中有快取也要更新後端的時間，否則後端仍可能回收
+        return self.backend.touch(name)
+
+    def put(self, name, data):
+        self.backend.put(name, data)
+        self._remember(name, data)
+
+    def get(self, name):
+        with self._lock:
+            data = self._cache.get(name)
+            if data is not None:
+                self._cache.move_to_end(name)
+                return data
+        data = self.backend.get(name)
+        if data is not None:
+            self._remember(name, data)
+        return data
+
+    def gc(self, max_age):
+        removed = self.backend.gc(max_age)
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+        return removed
+
+    def _remember(self, name, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                return
+            self._cache[name] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+def start_gc(store, max_age, interval=3600):
+    """定期回收超過 max_age 秒未使用的圖片"""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = store.gc(max_age)
+                if removed:
+                    logging.info(f"image_store: 已回收 {removed} 張圖片")
+            except Exception as e:
+                logging.error(f"image_store: 回收圖片失敗: {e}")
+
+    thread = threading.Thread(target=run, name="image-gc", daemon=True)
+    thread.start()
+    return thread
+
+
+def create_image_store(settings, mongo_client=None):
+    """依設定建立圖片儲存，backend 可為 local 或 gridfs"""
+    if settings.get("backend", "local") == "gridfs":
+        backend = GridFSImageStore(mongo_client[settings.get("database", "accounting")])
+    else:
+        backend = LocalImageStore(settings.get("directory", "images"))
+    return CachedImageStore(backend, settings.get("memory_cache_bytes", 16 * 1024 * 1024))
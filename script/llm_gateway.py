@@ -0,0 +1,278 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import openai
+from script.clients import registry, config
+from script.metrics import LLM_SECONDS, LLM_ERRORS, LLM_INPUT_TOKENS
+
+LATENCY_BUCKETS = (0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60)
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """事件的剩餘時間已不足以完成 LLM 呼叫"""
+
+
+class CircuitOpen(Exception):
+    """模型錯誤過多，暫停呼叫"""
+
+
+# 經過 gateway 的呼叫最終可能拋出的錯誤，呼叫端據此回覆失敗訊息
+GATEWAY_ERRORS = (DeadlineExceeded, CircuitOpen, openai.APIError)
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """在此範圍內的 LLM 呼叫都不會超過 deadline（time.time() 秒）"""
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def event_deadline(event, reply_token_ttl=None, margin=None):
+    """由事件時間推算 reply token 失效前的最後期限"""
+    ttl = reply_token_ttl if reply_token_ttl is not None else config.get("reply_token_ttl", 60)
+    margin = margin if margin is not None else config.get("deadline_margin", 3)
+    timestamp = getattr(event, "timestamp", None)
+    start = timestamp / 1000 if timestamp else time.time()
+    return start + ttl - margin
+
+
+class ModelStats:
+    """單一模型的延遲直方圖、錯誤數與斷路器狀態"""
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.count = 0
+        self.errors = {}
+        self.recent = deque(maxlen=200)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.half_open_trial = False
+        self.input_tokens = 0
+        self.cached_tokens = 0
+
+    def observe_tokens(self, input_tokens, cached_tokens):
+        self.input_tokens += input_tokens
+        self.cached_tokens += cached_tokens
+
+    def observe(self, latency):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+        self.latency_sum += latency
+        self.count += 1
+        self.recent.append(latency)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.half_open_trial = False
+
+    def fail(self, error):
+        self.reject(error)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def reject(self, error):
+        """記錄不代表服務異常的錯誤（如請求內容錯誤），不計入斷路器"""
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+        self.half_open_trial = False
+
+    def allow(self):
+        """斷路器關閉或冷卻結束後允許一次試探呼叫"""
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown or self.half_open_trial:
+            return False
+        self.half_open_trial = True
+        return True
+
+    def p95(self, min_samples=20):
+        if len(self.recent) < min_samples:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[int(len(ordered) * 0.95)]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "latency_sum": self.latency_sum,
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], self.buckets)),
+            "p95": self.p95(),
+            "errors": dict(self.errors),
+            "circuit_open": self.opened_at is not None,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": self.cached_tokens / self.input_tokens if self.input_tokens else 0.0,
+        }
+
+
+class LLMGateway:
+    """所有 OpenAI Responses API 呼叫的共同入口
+
+    - 依事件剩餘時間設定每次呼叫的逾時
+    - 可重試的錯誤以隨機抖動的指數退避重試
+    - 主要模型超過其 p95 延遲仍未回應時，同時對備援模型送出對沖請求
+    - 連續錯誤過多時開啟斷路器，冷卻期間直接改用備援模型
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else config.get("llm_gateway", {})
+        self.fallback_model = self.settings.get("fallback_model", "gpt-4.1-mini")
+        self.default_timeout = self.settings.get("timeout", 60)
+        self.max_retries = self.settings.get("max_retries", 2)
+        self.backoff_base = self.settings.get("backoff_base", 0.5)
+        self.backoff_cap = self.settings.get("backoff_cap", 4)
+        self.hedge = self.settings.get("hedge", True)
+        self._failure_threshold = self.settings.get("failure_threshold", 5)
+        self._cooldown = self.settings.get("cooldown", 30)
+        self._lock = threading.Lock()
+        self._models = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.settings.get("workers", 16), thread_name_prefix="llm"
+        )
+
+    def _stats(self, model):
+        with self._lock:
+            return self._stats_unlocked(model)
+
+    def remaining(self):
+        """目前事件在最後期限前剩餘的秒數，沒有期限時為預設逾時"""
+        return self._remaining(_deadline.get())
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return self.default_timeout
+        return min(self.default_timeout, deadline - time.time())
+
+    def _call(self, model, kwargs, timeout, prompt_name=None):
+        stats = self._stats(model)
+        start = time.monotonic()
+        try:
+            client = registry.openai().with_options(timeout=timeout, max_retries=0)
+            response = client.responses.create(model=model, **kwargs)
+        except Exception as e:
+            LLM_ERRORS.inc(model=model, error=type(e).__name__)
+            # 只有逾時、連線、限流與伺服器錯誤代表模型不可用，請求本身的錯誤不觸發斷路器
+            with self._lock:
+                if isinstance(e, RETRYABLE_ERRORS):
+                    stats.fail(e)
+                else:
+                    stats.reject(e)
+            raise
+        latency = time.monotonic() - start
+        LLM_SECONDS.observe(latency, model=model)
+        input_tokens, cached_tokens = input_token_usage(response)
+        with self._lock:
+            stats.observe(latency)
+            stats.observe_tokens(input_tokens, cached_tokens)
+        if input_tokens:
+            label = prompt_name or "other"
+            LLM_INPUT_TOKENS.inc(cached_tokens, model=model, prompt=label, cache="hit")
+            LLM_INPUT_TOKENS.inc(input_tokens - cached_tokens, model=model, prompt=label, cache="miss")
+            logging.info(
+                f"llm_gateway: {model} {label} 輸入 token {input_tokens}，"
+                f"快取 {cached_tokens} ({cached_tokens / input_tokens:.0%})，延遲 {latency:.2f}s"
+            )
+        return response
+
+    def _pick_model(self, model):
+        with self._lock:
+            if self._stats_unlocked(model).allow():
+                return model, True
+            if model != self.fallback_model and self._stats_unlocked(self.fallback_model).allow():
+                logging.warning(f"llm_gateway: {model} 斷路器開啟，改用 {self.fallback_model}")
+                return self.fallback_model, False
+        raise CircuitOpen(model)
+
+    def _stats_unlocked(self, model):
+        stats = self._models.get(model)
+        if stats is None:
+            stats = self._models[model] = ModelStats(self._failure_threshold, self._cooldown)
+        return stats
+
+    def _attempt(self, model, kwargs, deadline, can_hedge, prompt_name=None):
+        """送出一次請求，必要時對備援模型對沖，回傳最先完成的結果"""
+        timeout = self._remaining(deadline)
+        if timeout <= 0:
+            raise DeadlineExceeded(model)
+        primary = self._executor.submit(self._call, model, kwargs, timeout, prompt_name)
+        p95 = self._stats(model).p95()
+        if not (can_hedge and self.hedge and p95 and model != self.fallback_model and p95 < timeout):
+            return primary.result()
+
+        done, _ = wait([primary], timeout=p95)
+        if done:
+            return primary.result()
+        remaining = self._remaining(deadline)
+        with self._lock:
+            fallback_allowed = self._stats_unlocked(self.fallback_model).allow()
+        if remaining <= 0 or not fallback_allowed:
+            return primary.result()
+        logging.info(f"llm_gateway: {model} 超過 p95 {p95:.2f}s，對沖至 {self.fallback_model}")
+        hedge = self._executor.submit(self._call, self.fallback_model, kwargs, remaining, prompt_name)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def create(self, model, prompt_name=None, **kwargs):
+        """呼叫 client.responses.create，回傳 Response
+
+        prompt_name 只用於依提示詞統計輸入與快取命中的 token 數，不會送出。
+        """
+        deadline = _deadline.get()
+        attempt = 0
+        while True:
+            chosen, can_hedge = self._pick_model(model)
+            try:
+                return self._attempt(chosen, kwargs, deadline, can_hedge, prompt_name)
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                if attempt > self.max_retries or self._remaining(deadline) <= delay:
+                    raise
+                logging.warning(f"llm_gateway: {chosen} 呼叫失敗（{type(e).__name__}），{delay:.2f}s 後重試")
+                time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {model: stats.snapshot() for model, stats in self._models.items()}
+
+
+def input_token_usage(response):
+    """回傳 (輸入 token 數, 其中命中 prompt 快取的 token 數)"""
+    usage = getattr(response, "usage", None)
+    input_tokens = getattr(usage, "input_tokens", None) or 0
+    details = getattr(usage, "input_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    return input_tokens, min(cached_tokens, input_tokens)
+
+
+gateway = LLMGateway()
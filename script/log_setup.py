@@ -0,0 +1,45 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+_listener = None
+
+
+def setup_logging(settings, per_process=False):
+    """日誌經由佇列交給背景執行緒寫檔，請求執行緒不會被磁碟 I/O 阻塞
+
+    多個 worker 程序時各自寫入以 PID 區分的檔案，避免同時寫入與輪替同一個檔案。
+    每個程序只設定一次，重複呼叫直接回傳既有的 listener。
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    directory = settings.get("directory", "log")
+    os.makedirs(directory, exist_ok=True)
+    filename = settings.get("filename", "mybot.log")
+    if per_process:
+        stem, ext = os.path.splitext(filename)
+        filename = f"{stem}.{os.getpid()}{ext}"
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(directory, filename),
+        maxBytes=settings.get("max_bytes", 10 * 1024 * 1024),
+        backupCount=settings.get("backup_count", 5),
+        encoding="utf-8",
+    )
+    file_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%Y-%m-%d %H:%M:%S")
+    )
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    logging.basicConfig(
+        level=getattr(logging, settings.get("level", "INFO")),
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+        force=True,
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    _listener = listener
+    return listener
@@ -1,103 +1,136 @@
-from pymongo import MongoClient
 import logging
-from openai import OpenAI
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 import json
-import time
-import os
+from pymongo import UpdateOne
 from script.image_processor import ImageProcessor
-from script.generate_graph import GenPieChart
+from script.generate_graph import ChartRenderer
+from script.image_store import create_image_store
+from script.clients import registry, config
+from script.quick_parser import QuickParser, round_amount
+from script.migrate import ensure_indexes
+from script.receipt_cache import ReceiptCache
+from script.llm_gateway import gateway
+from script.prompts import prompts
+from script.metrics import stage
+from script.services import services
 from linebot.v3.messaging import (
-    Configuration,
     ReplyMessageRequest,
     TextMessage,
     ImageMessage,
 )
 
-secret = json.loads(open("config/secret.json", "r").read())
-config = json.loads(open("config/config.json", "r").read())
-configuration = Configuration(access_token=secret["access_token"])
-image_processor = ImageProcessor(configuration)
+image_processor = ImageProcessor()
+QUICK_PARSE_THRESHOLD = config.get("quick_parse_threshold", 0.8)
+
+_media_lock = threading.Lock()
+_image_store = None
+_chart_renderer = None
+
+
+def get_image_store():
+    """共用的圖表儲存，第一次使用時才建立（fork 之後）"""
+    global _image_store
+    if _image_store is None:
+        with _media_lock:
+            if _image_store is None:
+                _image_store = create_image_store(config.get("image_store", {}), registry.mongo())
+    return _image_store
+
+
+def get_chart_renderer():
+    """共用的圖表繪製執行緒池"""
+    global _chart_renderer
+    if _chart_renderer is None:
+        store = get_image_store()
+        with _media_lock:
+            if _chart_renderer is None:
+                _chart_renderer = ChartRenderer(store, workers=config.get("chart_workers", 2))
+    return _chart_renderer
 
 
 class Accounting:
     def __init__(self):
-        self.client = MongoClient("mongodb://localhost:27017/")
-        self.db = self.client['accounting']
-        self.client = OpenAI(
-            api_key=secret["openai"]
+        self.db = registry.mongo()['accounting']
+        self.ensure_indexes()
+        self.receipt_cache = ReceiptCache(
+            self.db.receipt_hashes,
+            threshold=config.get("receipt_hash_threshold", 8),
         )
         logging.info("manay: class initialized")
 
+    def ensure_indexes(self):
+        """啟動時建立查詢所需的索引（已存在時不會重建）"""
+        try:
+            ensure_indexes(self.db)
+        except Exception as e:
+            logging.error(f"manay: 建立索引失敗: {e}")
+
     def parse_message(self, event):
-        """解析用戶訊息，使用OpenAI識別收入/支出、金額和品名"""
+        """解析用戶訊息，使用OpenAI識別收入/支出、金額和品名，一則訊息可含多筆交易"""
         message = event.message.text
         user_id = event.source.user_id
         
-        # 使用OpenAI API解析訊息
-        prompt = open("prompt/accounting_prompt.txt", "r").read()
-        prompt = prompt.replace("{message}", message)
-        try:
-            response = self.client.responses.create(
-                model=config["model"],
-                input=[{"role": "user", "content": prompt}]
-            ).output_text
-        except json.JSONDecodeError as e:
-            logging.error(f"manay: 解析OpenAI回應失敗: {e}")
-            return {"type": "error"}
+        # 簡單的記帳訊息先用本地規則解析，信心不足才呼叫OpenAI
+        quick_results = QuickParser.parse_many(message)
+        if quick_results is None:
+            quick_result = QuickParser.parse(message)
+            quick_results = [quick_result] if quick_result is not None else None
+        if quick_results and min(r["confidence"] for r in quick_results) >= QUICK_PARSE_THRESHOLD:
+            logging.info(f"manay: 本地解析成功，{len(quick_results)} 筆")
+            response = json.dumps({"type": "記帳", "transactions": quick_results}, ensure_ascii=False)
+        else:
+            # 使用OpenAI API解析訊息，固定的指示在前、使用者訊息在最後以重用 prompt 快取
+            try:
+                with stage("accounting_llm"):
+                    response = gateway.create(
+                        model=config["model"],
+                        input=[
+                            {"role": "system", "content": prompts.text("accounting_prompt")},
+                            {"role": "user", "content": message},
+                        ],
+                        prompt_name="accounting_prompt",
+                    ).output_text
+            except Exception as e:
+                logging.error(f"manay: OpenAI API呼叫失敗: {e}")
+                return {"type": "error"}
             
         try:
             parsed_result = json.loads(response)
-            parsed_result['user_id'] = user_id
-            if parsed_result["type"] == "收入" or parsed_result["type"] == "支出":
-                # 成功解析為記帳資訊
-                if self.save_db(parsed_result):
-                    now = datetime.now()
-                    y = now.year
-                    m = now.month
-                    d = now.day
-                    if parsed_result["year"] is None and parsed_result["month"] is None and parsed_result["day"] is None:
-                        y = now.year
-                        m = now.month
-                        d = now.day
-                    else:
-                        y = parsed_result["year"]
-                        m = parsed_result["month"]
-                        d = parsed_result["day"]
-                        
-                    if parsed_result.get('type') == '收入':
-                        response_text = f"✅ 已記錄收入：\n在{y}年{m}月{d}日 {parsed_result['item']} 賺了 {parsed_result['amount']}元"
-                    else:  # 支出
-                        response_text = f"✅ 已記錄支出：\n在{y}年{m}月{d}日 {parsed_result['item']} 花了 {parsed_result['amount']}元"
-                    
-                    # 取得當月統計
-                    now = datetime.now()
-                    summary = self.get_monthly_summary(user_id, now.year, now.month)
-                    response_text += f"\n\n本月收入：{summary['income']}元\n本月支出：{summary['expense']}元\n本月結餘：{summary['balance']}元"
-                else:
-                    response_text = "❌ 記帳失敗，請稍後再試"
-                
+            transactions = extract_transactions(parsed_result, user_id)
+            if transactions:
+                # 成功解析為記帳資訊，多筆交易一次寫入並合併回覆
+                if self.save_records(transactions):
+                    return self.saved_reply(event, transactions)
                 return ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text=response_text)],
+                    messages=[TextMessage(text="❌ 記帳失敗，請稍後再試")],
                 )
             
-            elif parsed_result["type"] == "分析":
+            elif isinstance(parsed_result, dict) and parsed_result.get("type") == "分析":
                 logging.debug("main: 收到分析請求")
-                spending_data = list()
-                if "month" in parsed_result and "year" in parsed_result:
-                    spending_data = self.get_records(user_id, parsed_result["year"], parsed_result["month"])
-                    
-                elif "month" in parsed_result:
-                    spending_data = self.get_records(user_id, datetime.now().year, parsed_result["month"])
+                now = datetime.now()
+                year = parsed_result.get("year")
+                month = parsed_result.get("month")
+                days = parsed_result.get("days")
+                if days:
+                    # 跨月份的區間（如最近 90 天）無法由 monthly_totals 取得，改在資料庫端依日期彙總
+                    end = datetime(now.year, now.month, now.day) + timedelta(days=1)
+                    rows = self.aggregate_range(user_id, end - timedelta(days=max(1, int(days))), end)
+                    category_sums = {row['_id'] or '其他': row['total'] for row in rows if row['total'] > 0}
                 else:
-                    spending_data = self.get_records(user_id, datetime.now().year, datetime.now().month)
-                GenPieChart.generate_pie_chart(spending_data)
-                trailing = f"images/{user_id}.png"
-                image_url = f"https://{config['url']}/{trailing}"
-                while not os.path.exists(trailing):
-                    time.sleep(0.5)
-                    
+                    if year is None and month is None:
+                        year, month = now.year, now.month
+                    elif year is None:
+                        year = now.year
+                    category_sums = self.get_category_sums(user_id, year, month)
+                # 圖片在背景繪製，/images 路由會等待本程序的繪製完成；
+                # 共用儲存或多個 worker 時，其他程序看不到本機的繪製進度，需先等待寫入完成
+                filename, future = get_chart_renderer().render_async(category_sums)
+                if get_image_store().shared or services.worker_processes > 1:
+                    future.result(timeout=10)
+                image_url = f"https://{config['url']}/images/{filename}"
+
                 return ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[
@@ -109,33 +142,39 @@ class Accounting:
                 )
  
         except Exception as e:
-            logging.error(f"manay: OpenAI API呼叫失敗: {e}")
+            logging.error(f"manay: 解析OpenAI回應失敗: {e}")
             return {"type": "error"}
         
     def parse_image(self, event):
-        """解析圖片，使用OpenAI識別收入/支出、金額和品名"""
+        """解析收據圖片，逐項收據可拆成多筆交易"""
         image_data = image_processor.download_image(event.message.id)
         if not image_data:
             logging.warning("manay: 下載圖片失敗")
             return {"type": "error"}
+
+        user_id = event.source.user_id
+        # 重複傳送的同一張收據直接回覆先前的結果，不再呼叫OpenAI或重複記帳
+        cached = self.receipt_cache.lookup(user_id, image_data.phash)
+        if cached is not None:
+            return ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=format_duplicate_text(cached))],
+            )
         
-        prompt = open("prompt/accounting_prompt.txt", "r").read()
-        messages = [{"role": "user", "content": prompt}]
+        # 確定不是重複的收據才上傳，聊天備援與之後的追問沿用同一個 file_id
+        image_processor.upload(image_data)
+        messages = [{"role": "system", "content": prompts.text("accounting_image")}]
         messages.append({
             "role": "user",
-            "content": [
-                {
-                    "type": "input_image",
-                    "image_url": f"data:image/jpeg;base64,{image_data}",
-                    "detail": "high"  # 可選參數，控制圖片解析度
-                }
-            ]
+            "content": [image_data.input_content()]
         })
         try:
-            response = self.client.responses.create(
-                model="gpt-4.1",
-                input=messages
-            ).output_text
+            with stage("receipt_llm"):
+                response = gateway.create(
+                    model="gpt-4.1",
+                    input=messages,
+                    prompt_name="accounting_image",
+                ).output_text
         except Exception as e:
             logging.error(f"manay: OpenAI API呼叫失敗: {e}")
             return ReplyMessageRequest(
@@ -148,103 +187,228 @@ class Accounting:
             logging.error(f"manay: OpenAI解析圖片失敗: {e}")
             return {"type": "error", "image": image_data}
 
-        if parsed_data["type"] == "收入" or parsed_data["type"] == "支出":
-            parsed_data['user_id'] = event.source.user_id
-            if self.save_db(parsed_data):
-                now = datetime.now()
-                y = now.year
-                m = now.month
-                d = now.day
-                if parsed_data["year"] is None and parsed_data["month"] is None and parsed_data["day"] is None:
-                    y = now.year
-                    m = now.month
-                    d = now.day
-                else:
-                    y = parsed_data["year"]
-                    m = parsed_data["month"]
-                    d = parsed_data["day"]
-                    
-                if parsed_data.get('type') == '收入':
-                    response_text = f"✅ 已記錄收入：\n在{y}年{m}月{d}日 {parsed_data['item']} 賺了 {parsed_data['amount']}元"
-                else:  # 支出
-                    response_text = f"✅ 已記錄支出：\n在{y}年{m}月{d}日 {parsed_data['item']} 花了 {parsed_data['amount']}元"
-                
-                return ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=response_text)],
-                )
-            else:
-                logging.error("manay: 儲存資料庫失敗")
-                return ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="❌ 記帳失敗，請稍後再試")],
-                )
+        transactions = extract_transactions(parsed_data, user_id)
+        if transactions:
+            if self.save_records(transactions):
+                self.receipt_cache.store(user_id, image_data.phash, transactions)
+                return self.saved_reply(event, transactions)
+            logging.error("manay: 儲存資料庫失敗")
+            return ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="❌ 記帳失敗，請稍後再試")],
+            )
+        if isinstance(parsed_data, dict) and parsed_data.get("type") == "無法辨識":
+            return ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=f"❌ 無法辨識收據：{parsed_data.get('reason', '')}")],
+            )
+        # 非收據的圖片交給聊天助理描述
+        return {"type": "error", "image": image_data}
+
+    def saved_reply(self, event, records):
+        """記帳成功的合併回覆，附上當月統計"""
+        response_text = format_saved_text(records)
+        now = datetime.now()
+        summary = self.get_monthly_summary(records[0]['user_id'], now.year, now.month)
+        response_text += f"\n\n本月收入：{summary['income']}元\n本月支出：{summary['expense']}元\n本月結餘：{summary['balance']}元"
+        return ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=response_text)],
+        )
     
-    def save_db(self, record=None):
-        """將記帳記錄儲存到MongoDB"""
-        if record is None:
+    def save_records(self, records):
+        """以單次 insert_many 儲存多筆記帳記錄並更新 monthly_totals"""
+        if not records:
             logging.error("manay: 沒有提供記帳資料，無法儲存")
             return False
             
-        # 補充時間戳記
+        # 補充交易日期與時間戳記
         now = datetime.now()
-        if record["month"] is None:
-            record["month"] = now.month
-        if record["year"] is None:
-            record["year"] = now.year
-        if record["day"] is None:
-            record["day"] = now.day
-        record.update({
-            'created_at': now,
-            'updated_at': now
-        })
+        for record in records:
+            for field, default in (("year", now.year), ("month", now.month), ("day", now.day)):
+                if record.get(field) is None:
+                    record[field] = default
+            record['date'] = record_date(record, now)
+            record.update({
+                'created_at': now,
+                'updated_at': now
+            })
         
         try:
-            result = self.db.records.insert_one(record)
-            logging.info(f"manay: 記帳記錄已儲存，ID: {result.inserted_id}")
+            with stage("mongo_save"):
+                result = self.db.records.insert_many(records)
+                self.update_monthly_totals(records)
+            logging.info(f"manay: 已儲存 {len(result.inserted_ids)} 筆記帳記錄")
             return True
         except Exception as e:
             logging.error(f"manay: 資料庫儲存失敗: {e}")
             return False
             
-    def get_records(self, user_id, year=None, month=None):
-        """查詢特定用戶的記帳記錄"""
-        query = {'user_id': user_id}
-        
-        if year:
-            query['year'] = year
+    def aggregate_range(self, user_id, start, end, group_by='category', record_type='支出'):
+        """在資料庫端依區間彙總金額，group_by 可為 category、month 或 day"""
+        keys = {
+            'category': '$category',
+            'month': {'year': {'$year': '$date'}, 'month': {'$month': '$date'}},
+            'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}},
+        }
+        match = {'user_id': user_id, 'date': {'$gte': start, '$lt': end}}
+        if record_type:
+            match['type'] = record_type
+        pipeline = [
+            {'$match': match},
+            {'$project': {'_id': 0, 'date': 1, 'category': 1, 'amount': 1}},
+            {'$group': {'_id': keys[group_by], 'total': {'$sum': '$amount'}, 'count': {'$sum': 1}}},
+            {'$sort': {'_id': 1}},
+        ]
+        try:
+            return list(self.db.records.aggregate(pipeline))
+        except Exception as e:
+            logging.error(f"manay: 區間統計失敗: {e}")
+            return []
+
+    def update_monthly_totals(self, records, sign=1):
+        """以 $inc 原子更新 monthly_totals，sign=-1 可用於刪除記錄時扣回"""
+        try:
+            apply_monthly_totals(self.db, records, sign)
+        except Exception as e:
+            logging.error(f"manay: 更新月度統計失敗: {e}")
+
+    def get_category_sums(self, user_id, year, month=None):
+        """由 monthly_totals 取得支出分類加總，未指定月份時加總全年"""
+        query = {'user_id': user_id, 'year': year}
         if month:
             query['month'] = month
-            
+        category_sums = dict()
         try:
-            records = list(self.db.records.find(query))
-            return records
+            for totals in self.db.monthly_totals.find(query, {'categories': 1}):
+                for key, amount in totals.get('categories', {}).items():
+                    category = decode_category(key)
+                    category_sums[category] = category_sums.get(category, 0) + amount
         except Exception as e:
-            logging.error(f"manay: 查詢記錄失敗: {e}")
-            return []
-            
+            logging.error(f"manay: 查詢分類統計失敗: {e}")
+        return {k: v for k, v in category_sums.items() if v > 0}
+
     def get_monthly_summary(self, user_id, year, month):
         """取得月度收支統計"""
         try:
-            pipeline = [
-                {'$match': {'user_id': user_id, 'year': year, 'month': month}},
-                {'$group': {
-                    '_id': '$type',
-                    'total': {'$sum': '$amount'}
-                }}
-            ]
-            
-            result = list(self.db.records.aggregate(pipeline))
-            summary = {'income': 0, 'expense': 0}
-            
-            for item in result:
-                if item['_id'] == '收入':
-                    summary['income'] = item['total']
-                elif item['_id'] == '支出':
-                    summary['expense'] = item['total']
-                    
+            with stage("monthly_summary"):
+                totals = self.db.monthly_totals.find_one(
+                    {'user_id': user_id, 'year': year, 'month': month},
+                    {'income': 1, 'expense': 1},
+                ) or {}
+            summary = {
+                'income': totals.get('income', 0),
+                'expense': totals.get('expense', 0),
+            }
             summary['balance'] = summary['income'] - summary['expense']
             return summary
         except Exception as e:
             logging.error(f"manay: 計算月度統計失敗: {e}")
-            return {'income': 0, 'expense': 0, 'balance': 0}
\ No newline at end of file
+            return {'income': 0, 'expense': 0, 'balance': 0}
+
+
+def extract_transactions(parsed, user_id):
+    """將解析結果統一為交易列表，接受 transactions 陣列或舊的單筆格式"""
+    if isinstance(parsed, list):
+        items = parsed
+    elif isinstance(parsed, dict) and "transactions" in parsed:
+        items = parsed["transactions"] or []
+    elif isinstance(parsed, dict):
+        items = [parsed]
+    else:
+        return []
+    transactions = []
+    for item in items:
+        if not isinstance(item, dict) or item.get("type") not in ("收入", "支出"):
+            continue
+        amount = item.get("amount")
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)) or amount <= 0:
+            continue
+        item["amount"] = round_amount(amount)
+        item["user_id"] = user_id
+        transactions.append(item)
+    return transactions
+
+
+def format_saved_text(records):
+    if len(records) == 1:
+        record = records[0]
+        if record['type'] == '收入':
+            return f"✅ 已記錄收入：\n在{record['year']}年{record['month']}月{record['day']}日 {record['item']} 賺了 {record['amount']}元"
+        return f"✅ 已記錄支出：\n在{record['year']}年{record['month']}月{record['day']}日 {record['item']} 花了 {record['amount']}元"
+    lines = [f"✅ 已記錄 {len(records)} 筆："]
+    for record in records:
+        action = "賺了" if record['type'] == '收入' else "花了"
+        lines.append(f"・{record['month']}/{record['day']} {record['item']} {action} {record['amount']}元")
+    income = sum(r['amount'] for r in records if r['type'] == '收入')
+    expense = sum(r['amount'] for r in records if r['type'] == '支出')
+    if income:
+        lines.append(f"合計收入：{income}元")
+    if expense:
+        lines.append(f"合計支出：{expense}元")
+    return "\n".join(lines)
+
+
+def format_duplicate_text(result):
+    records = result.get('transactions') or [result]
+    lines = ["⚠️ 這張收據先前已記錄過："]
+    for record in records:
+        action = "賺了" if record.get('type') == '收入' else "花了"
+        lines.append(
+            f"在{record['year']}年{record['month']}月{record['day']}日 "
+            f"{record['item']} {action} {record['amount']}元"
+        )
+    lines.append("若這是另一張收據，請以文字輸入記帳。")
+    return "\n".join(lines)
+
+
+def record_date(record, default):
+    """由 year/month/day 組出交易日期，日期不合法時使用 default"""
+    try:
+        return datetime(int(record['year']), int(record['month']), int(record['day']))
+    except (KeyError, TypeError, ValueError):
+        return datetime(default.year, default.month, default.day)
+
+
+def encode_category(category):
+    """MongoDB 欄位名稱不可含 . 或以 $ 開頭"""
+    return str(category).replace('.', '\uff0e').replace('$', '\uff04')
+
+
+def decode_category(key):
+    return key.replace('\uff0e', '.').replace('\uff04', '$')
+
+
+def rollup_increments(record, sign=1):
+    """單筆記錄對 monthly_totals 的增量"""
+    amount = record['amount'] * sign
+    if record['type'] == '收入':
+        return {'income': amount, 'count': sign}
+    return {
+        'expense': amount,
+        'count': sign,
+        f"categories.{encode_category(record.get('category') or '其他')}": amount,
+    }
+
+
+def monthly_increments(records, sign=1):
+    """多筆記錄對 monthly_totals 的增量，同一月份合併，鍵為 (user_id, year, month)"""
+    totals = {}
+    for record in records:
+        month_totals = totals.setdefault((record['user_id'], record['year'], record['month']), {})
+        for field, amount in rollup_increments(record, sign).items():
+            month_totals[field] = month_totals.get(field, 0) + amount
+    return totals
+
+
+def apply_monthly_totals(db, records, sign=1):
+    """以一次 bulk_write 將多筆記錄的增量寫入 monthly_totals"""
+    now = datetime.now()
+    db.monthly_totals.bulk_write([
+        UpdateOne(
+            {'user_id': user_id, 'year': year, 'month': month},
+            {'$inc': increments, '$set': {'updated_at': now}},
+            upsert=True,
+        )
+        for (user_id, year, month), increments in monthly_increments(records, sign).items()
+    ], ordered=False)
@@ -0,0 +1,75 @@
+"""記帳資料庫維護指令
+
+gunicorn 啟動時 master 會在 fork worker 前執行 startup；以其他方式部署時，請於啟動服務前執行：
+    python -m script.migrate startup
+也可單獨執行：
+    python -m script.migrate ensure-indexes
+    python -m script.migrate backfill-dates
+"""
+import argparse
+import logging
+from datetime import datetime
+from script.clients import registry
+
+
+def ensure_indexes(db):
+    db.records.create_index([('user_id', 1), ('date', 1)])
+    db.records.create_index([('user_id', 1), ('type', 1), ('date', 1)])
+    db.monthly_totals.create_index([('user_id', 1), ('year', 1), ('month', 1)], unique=True)
+
+
+def backfill_dates(db):
+    """為舊記錄補上 date 欄位，於資料庫端以 year/month/day 組出日期"""
+    result = db.records.update_many(
+        {'date': {'$exists': False}, 'year': {'$type': 'number'}, 'month': {'$type': 'number'}},
+        [{'$set': {'date': {'$dateFromParts': {
+            'year': '$year',
+            'month': '$month',
+            'day': {'$ifNull': ['$day', 1]},
+        }}}}],
+    )
+    return result.modified_count
+
+
+def run_once(db, name, task):
+    """執行尚未完成的一次性維護工作，成功後才於 migrations 寫入標記；已完成時回傳 None"""
+    if db.migrations.find_one({'_id': name}, {'_id': 1}) is not None:
+        return None
+    result = task(db)
+    db.migrations.update_one(
+        {'_id': name}, {'$set': {'done_at': datetime.now(), 'result': result}}, upsert=True
+    )
+    return result
+
+
+def run_startup_migrations(db):
+    """在接受請求前執行：建立索引、為舊記錄補上 date（依日期區間的查詢才找得到）、由 records 重建 monthly_totals
+
+    須在任何 worker 寫入記錄之前執行，重建時才不會覆蓋並行的 $inc。
+    """
+    from script.rollup import rebuild_all
+    ensure_indexes(db)
+    for name, task in (('backfill_dates', backfill_dates), ('monthly_totals_rebuild', rebuild_all)):
+        result = run_once(db, name, task)
+        if result is not None:
+            logging.info(f"migrate: {name} 完成，{result} 筆")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['startup', 'ensure-indexes', 'backfill-dates'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = registry.mongo()['accounting']
+    if args.command == 'startup':
+        run_startup_migrations(db)
+    elif args.command == 'ensure-indexes':
+        ensure_indexes(db)
+        print(db.records.index_information())
+    else:
+        print(f"已補上 {backfill_dates(db)} 筆記錄的 date 欄位")
+
+
+if __name__ == '__main__':
+    main()
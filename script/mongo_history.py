@@ -1,26 +1,197 @@
-from langchain_mongodb.chat_message_histories import MongoDBChatMessageHistory
-from pymongo import MongoClient
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    message_to_dict,
+    messages_from_dict,
+)
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError
+from .clients import registry, config
+
+HISTORY_SIZE = 30  # 限制歷史記錄數量
+DUPLICATE_KEY = 11000
+
+
+def _to_dict(message):
+    return {
+        "role": "user" if message.type == "human" else "assistant",
+        "content": message.content,
+    }
+
+
+class HistoryCache:
+    """以 LRU 保存近期會話歷史，依總大小上限與 TTL 淘汰"""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(messages):
+        return sum(len(m["content"]) * 4 + 64 for m in messages if isinstance(m["content"], str))
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry["loaded_at"] > self.ttl:
+                self._drop(session_id)
+                return None
+            self._entries.move_to_end(session_id)
+            return list(entry["messages"])
+
+    def put(self, session_id, messages):
+        with self._lock:
+            if session_id in self._entries:
+                self._drop(session_id)
+            size = self._size(messages)
+            self._entries[session_id] = {
+                "messages": messages,
+                "size": size,
+                "loaded_at": time.monotonic(),
+            }
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+
+    def append(self, session_id, new_messages, limit):
+        """若會話已在快取中則直接附加，回傳是否成功"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return False
+            messages = (entry["messages"] + new_messages)[-limit:]
+            self._bytes -= entry["size"]
+            entry["messages"] = messages
+            entry["size"] = self._size(messages)
+            self._bytes += entry["size"]
+            self._entries.move_to_end(session_id)
+            return True
+
+    def _drop(self, session_id):
+        entry = self._entries.pop(session_id)
+        self._bytes -= entry["size"]
+
 
 class MongoHistoryManager:
+    """聊天歷史讀取走記憶體快取，寫入先暫存再由背景執行緒批次 insert_many"""
+
     def __init__(self):
-        self.conn_str = "mongodb://localhost:27017/"
-        self.client = MongoClient(self.conn_str)
+        self.client = registry.mongo()
         self.db = self.client['line_chat_history']
-        
-    def get_history(self, session_id):
-        """獲取指定session_id的聊天歷史"""
-        return MongoDBChatMessageHistory(
-            connection_string=self.conn_str,
-            session_id=session_id,
-            database_name="line_chat_history",
-            collection_name="chat_records",
-            history_size=30  # 限制歷史記錄數量
+        self.collection = self.db['chat_records']
+        try:
+            self.collection.create_index("SessionId")
+        except Exception as e:
+            logging.error(f"mongo_history: 建立索引失敗: {e}")
+
+        settings = config.get("history_cache", {})
+        self.cache = HistoryCache(
+            max_bytes=settings.get("max_bytes", 32 * 1024 * 1024),
+            ttl=settings.get("ttl", 1800),
+        )
+        self.flush_interval = settings.get("flush_interval", 1.0)
+        self.batch_size = settings.get("batch_size", 100)
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._run_flusher, name="history-flusher", daemon=True
         )
-        
+        self._flusher.start()
+        atexit.register(self.flush)
+
     def get_messages_as_dict(self, session_id):
         """將歷史記錄轉換為字典格式供OpenAI API使用"""
-        history = self.get_history(session_id)
-        return [
-            {"role": "user" if msg.type == "human" else "assistant", "content": msg.content}
-            for msg in history.messages
+        messages = self.cache.get(session_id)
+        if messages is None:
+            messages = self._load(session_id)
+            self.cache.put(session_id, messages)
+        return messages
+
+    def append(self, session_id, messages):
+        """寫入快取並排入待寫佇列，實際寫入由背景批次完成"""
+        documents = [
+            {"SessionId": session_id, "History": json.dumps(message_to_dict(m))}
+            for m in messages
         ]
+        with self._pending_lock:
+            self._pending.extend(documents)
+            pending = len(self._pending)
+        self.cache.append(session_id, [_to_dict(m) for m in messages], HISTORY_SIZE)
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def append_turn(self, session_id, user_content, ai_content):
+        """一次寫入一輪對話（使用者與 AI 各一則）"""
+        self.append(
+            session_id,
+            [HumanMessage(content=user_content), AIMessage(content=ai_content)],
+        )
+
+    def flush(self):
+        """將暫存的歷史記錄以單次 insert_many 寫入 MongoDB"""
+        with self._flush_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            # insert_many 會在文件上填入 _id，重試時沿用同一個 _id，
+            # 已寫入的文件以重複鍵錯誤略過，寫入可安全重試
+            try:
+                self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                failed = {
+                    error["index"] for error in e.details.get("writeErrors", [])
+                    if error.get("code") != DUPLICATE_KEY
+                }
+                if failed:
+                    logging.error(f"mongo_history: 批次寫入 {len(failed)} 筆失敗，保留待重試")
+                    with self._pending_lock:
+                        self._pending = [batch[i] for i in sorted(failed)] + self._pending
+                return len(batch) - len(failed)
+            except Exception as e:
+                logging.error(f"mongo_history: 批次寫入失敗，保留 {len(batch)} 筆待重試: {e}")
+                with self._pending_lock:
+                    self._pending = batch + self._pending
+                return 0
+            return len(batch)
+
+    def _load(self, session_id):
+        # 持有 flush 鎖，避免讀取期間有批次剛好寫入而漏讀
+        with self._flush_lock:
+            return self._load_unlocked(session_id)
+
+    def _load_unlocked(self, session_id):
+        cursor = (
+            self.collection.find({"SessionId": session_id}, {"History": 1})
+            .sort("_id", DESCENDING)
+            .limit(HISTORY_SIZE)
+        )
+        items = [json.loads(document["History"]) for document in cursor]
+        items.reverse()
+        # 尚未寫入 MongoDB 的訊息也要納入
+        with self._pending_lock:
+            items += [
+                json.loads(document["History"])
+                for document in self._pending
+                if document["SessionId"] == session_id
+            ]
+        return [_to_dict(m) for m in messages_from_dict(items[-HISTORY_SIZE:])]
+
+    def _run_flusher(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
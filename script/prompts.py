@@ -0,0 +1,93 @@
+"""prompt/ 目錄下的提示詞
+
+啟動時載入一次並以內容雜湊作為版本，之後最多每 check_interval 秒檢查一次修改時間，
+檔案有變動才重新讀取，修改提示詞不需重啟。
+提示詞只放固定的指示，使用者內容一律放在最後一則訊息，
+讓每次呼叫的開頭完全相同，OpenAI 才能重用快取的 prompt 前綴。
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from script.clients import config
+
+Prompt = namedtuple("Prompt", ["name", "text", "version", "mtime"])
+
+
+class PromptRegistry:
+    def __init__(self, directory="prompt", check_interval=2.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._prompts = {}
+        self._stamps = {}
+        self._checked_at = None
+        self._reloads = 0
+
+    def _scan(self):
+        """重新讀取修改時間或大小有變動的檔案"""
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as e:
+            logging.error(f"prompts: 無法讀取 {self.directory}: {e}")
+            return
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext != ".txt" or not entry.is_file():
+                continue
+            stat = entry.stat()
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if self._stamps.get(name) == stamp:
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    text = f.read()
+            except OSError as e:
+                logging.error(f"prompts: 讀取 {entry.name} 失敗: {e}")
+                continue
+            version = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+            previous = self._prompts.get(name)
+            self._stamps[name] = stamp
+            self._prompts[name] = Prompt(name, text, version, stat.st_mtime)
+            if previous is not None and previous.version != version:
+                self._reloads += 1
+                logging.info(f"prompts: 重新載入 {name} {previous.version} -> {version}")
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._checked_at is None or now - self._checked_at >= self.check_interval:
+                self._scan()
+                self._checked_at = now
+
+    def get(self, name):
+        """取得提示詞（檔名不含 .txt），回傳 Prompt"""
+        self._refresh()
+        prompt = self._prompts.get(name)
+        if prompt is None:
+            raise KeyError(f"找不到提示詞 {name}")
+        return prompt
+
+    def text(self, name):
+        return self.get(name).text
+
+    def version(self, name):
+        return self.get(name).version
+
+    def stats(self):
+        self._refresh()
+        with self._lock:
+            return {
+                "reloads": self._reloads,
+                "versions": {name: prompt.version for name, prompt in self._prompts.items()},
+            }
+
+
+prompts = PromptRegistry(
+    config.get("prompt_dir", "prompt"),
+    check_interval=config.get("prompt_reload_interval", 2),
+)
@@ -0,0 +1,289 @@
+import math
+import re
+from datetime import date, timedelta
+
+DIGITS = {
+    "零": 0, "〇": 0, "一": 1, "壹": 1, "二": 2, "兩": 2, "两": 2, "貳": 2,
+    "三": 3, "參": 3, "四": 4, "肆": 4, "五": 5, "伍": 5, "六": 6, "陸": 6,
+    "七": 7, "柒": 7, "八": 8, "捌": 8, "九": 9, "玖": 9,
+}
+SMALL_UNITS = {"十": 10, "拾": 10, "百": 100, "佰": 100, "千": 1000, "仟": 1000, "k": 1000, "K": 1000}
+BIG_UNITS = {"萬": 10000, "万": 10000, "億": 100000000}
+NUMERAL_CHARS = "".join(DIGITS) + "".join(SMALL_UNITS) + "".join(BIG_UNITS)
+
+WEEKDAYS = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6}
+
+# 關鍵詞參考 prompt/accounting_prompt.txt 的分析指南
+INCOME_KEYWORDS = (
+    "薪資", "薪水", "獎金", "入帳", "收到", "賣出", "借入", "退款", "拿到",
+    "賺", "還我", "打工", "股利", "利息", "領",
+)
+EXPENSE_KEYWORDS = (
+    "購買", "消費", "繳費", "支付", "買", "訂購", "花", "付", "請客", "贈送",
+    "轉帳給", "繳", "加值",
+)
+CATEGORY_KEYWORDS = {
+    "飲食": ("早午餐", "早餐", "午餐", "晚餐", "宵夜", "點心", "零食", "飲料", "咖啡", "奶茶", "珍奶",
+           "手搖", "便當", "麵", "飯", "水果", "下午茶", "吃"),
+    "交通": ("計程車", "小黃", "uber", "Uber", "捷運", "公車", "高鐵", "台鐵", "火車", "油錢",
+           "加油", "停車", "車資", "悠遊卡", "車票"),
+    "住宿": ("房租", "租金", "住宿", "飯店", "旅館", "水電", "管理費"),
+    "通訊": ("電話費", "手機費", "網路", "電信", "月租費"),
+    "醫療": ("看醫生", "掛號", "醫院", "診所", "藥", "牙醫", "看診"),
+    "教育": ("學費", "書", "課程", "補習", "上課"),
+    "社交活動": ("請客", "聚餐", "禮金", "紅包"),
+    "娛樂": ("電影", "遊戲", "KTV", "唱歌", "演唱會", "訂閱", "Netflix", "netflix"),
+    "購物": ("衣服", "鞋", "日用品", "網購", "蝦皮", "包包"),
+    "旅遊": ("機票", "旅遊", "門票", "旅行"),
+    "保險": ("保險", "保費"),
+    "債務": ("還款", "貸款", "卡費"),
+}
+INCOME_CATEGORIES = {
+    "工作": ("薪資", "薪水", "獎金", "打工", "兼職"),
+    "投資": ("股利", "利息", "股票"),
+}
+VERBS = (
+    "花了", "付了", "買了", "賺了", "拿到了", "收到了", "拿到", "收到", "入帳", "支付",
+    "購買", "繳了", "繳費", "繳", "付", "花", "買", "搭了", "搭", "坐", "吃了", "吃", "喝了", "喝",
+)
+# 數字後接量詞時是數量而不是金額（如「3杯咖啡」）
+COUNTER_WORDS = (
+    "杯", "碗", "雙", "個", "份", "張", "件", "本", "瓶", "罐", "包", "盒", "顆", "支", "枝", "台",
+    "隻", "條", "片", "盤", "串", "站", "次", "趟", "晚", "天", "位", "人", "間", "斤", "公斤", "組", "套",
+)
+NON_BOOKKEEPING_HINTS = ("?", "？", "嗎", "多少", "分析", "統計", "報表", "幾", "怎麼", "為什麼")
+
+CURRENCY_PREFIX = r"(?:NT\$|NTD|\$|＄)"
+CURRENCY_SUFFIX = r"(?:元|塊錢|塊|圓|NT|ntd|NTD)"
+AMOUNT_RE = re.compile(
+    rf"({CURRENCY_PREFIX})?\s*([\d,，.]*\d[\d,，.]*[{NUMERAL_CHARS}]*|[{NUMERAL_CHARS}]+)\s*({CURRENCY_SUFFIX})?"
+)
+DATE_PATTERNS = (
+    re.compile(r"(?:(\d{4}|[〇零一二三四五六七八九]{4})\s*年)?\s*([\d一二三四五六七八九十]{1,3})\s*月\s*([\d一二三四五六七八九十]{1,3})\s*[日號号]?"),
+    re.compile(r"(?:(\d{4})[/\-.])?(\d{1,2})/(\d{1,2})"),
+    re.compile(r"()()([\d一二三四五六七八九十]{1,3})\s*[號号]"),
+)
+RELATIVE_DAYS = (("大前天", -3), ("前天", -2), ("昨天", -1), ("昨日", -1), ("昨晚", -1),
+                 ("今天", 0), ("今日", 0), ("今晚", 0), ("明天", 1))
+SEGMENT_RE = re.compile(r"[\s,，、;；\n]+")
+WEEK_RE = re.compile(r"(上|這|本)(?:週|周|禮拜|星期)([一二三四五六日天])")
+
+
+def chinese_to_number(text):
+    """將「兩千五」、「3萬5」、「35,000」等表示轉為數值，無法解析時回傳 None"""
+    text = text.replace(",", "").replace("，", "")
+    if not text:
+        return None
+    if re.fullmatch(r"\d+(?:\.\d+)?", text):
+        value = float(text)
+        return int(value) if value.is_integer() else value
+    if all(ch in DIGITS for ch in text) and len(text) > 1:
+        # 「一二零」這類逐位念法
+        return int("".join(str(DIGITS[ch]) for ch in text))
+
+    total = 0
+    section = 0
+    number = None
+    last_unit = 1
+    buffer = ""
+    for ch in text + "\0":
+        if ch.isdigit() or ch == ".":
+            buffer += ch
+            continue
+        if buffer:
+            try:
+                number = float(buffer)
+            except ValueError:
+                return None
+            buffer = ""
+        if ch == "\0":
+            break
+        if ch in DIGITS and DIGITS[ch] == 0:
+            # 「一百零五」的零之後是個位數，不再補上省略的單位
+            last_unit = 1
+            number = None
+        elif ch in DIGITS:
+            number = DIGITS[ch]
+        elif ch in SMALL_UNITS:
+            unit = SMALL_UNITS[ch]
+            section += (1 if number is None else number) * unit
+            last_unit = unit
+            number = None
+        elif ch in BIG_UNITS:
+            unit = BIG_UNITS[ch]
+            section += number or 0
+            total += (section or 1) * unit
+            section = 0
+            last_unit = unit
+            number = None
+        else:
+            return None
+    if number is not None:
+        # 「兩千五」、「三萬五」省略末位單位
+        section += number * (last_unit // 10 if last_unit >= 10 else 1)
+    value = total + section
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else round(value, 2)
+    return value
+
+
+def round_amount(value):
+    """金額四捨五入為整數（round() 是銀行家捨入，2.5 會變成 2）"""
+    return int(math.floor(value + 0.5))
+
+
+class QuickParser:
+    """不呼叫 LLM 的記帳訊息解析器，輸出格式與 accounting_prompt.txt 相同"""
+
+    @staticmethod
+    def parse(message, today=None):
+        """回傳記帳結果（含 confidence），非記帳訊息回傳 None"""
+        today = today or date.today()
+        text = message.strip()
+        if not text or len(text) > 40 or any(h in text for h in NON_BOOKKEEPING_HINTS):
+            return None
+
+        confidence = 0.0
+        text, record_date = QuickParser._extract_date(text, today)
+
+        amount, text, marked = QuickParser._extract_amount(text)
+        if amount is None or amount <= 0:
+            return None
+        confidence += 0.4 if marked else 0.3
+
+        income_hit = any(k in text for k in INCOME_KEYWORDS)
+        expense_hit = any(k in text for k in EXPENSE_KEYWORDS)
+        category = QuickParser._match(text, INCOME_CATEGORIES if income_hit and not expense_hit else CATEGORY_KEYWORDS)
+        if income_hit and not expense_hit:
+            record_type = "收入"
+            confidence += 0.3
+        elif expense_hit and not income_hit:
+            record_type = "支出"
+            confidence += 0.3
+        elif not income_hit and category:
+            record_type = "支出"
+            confidence += 0.25
+        else:
+            record_type = "支出"
+        if category:
+            confidence += 0.2
+        else:
+            category = "其他"
+
+        item = QuickParser._extract_item(text)
+        if item:
+            confidence += 0.1
+        else:
+            item = category
+            confidence -= 0.1
+
+        return {
+            "type": record_type,
+            "amount": round_amount(amount),
+            "item": item,
+            "category": category,
+            "confidence": round(min(confidence, 1.0), 2),
+            "year": record_date.year if record_date else None,
+            "month": record_date.month if record_date else None,
+            "day": record_date.day if record_date else None,
+        }
+
+    @staticmethod
+    def parse_many(message, today=None):
+        """解析以空白或標點分隔的多筆交易（如「早餐50 午餐120」），每段都能解析時才回傳列表
+
+        開頭的日期套用到沒有自己日期的每一段。
+        """
+        today = today or date.today()
+        text = message.strip()
+        if not text or len(text) > 200 or any(h in text for h in NON_BOOKKEEPING_HINTS):
+            return None
+        text, shared_date = QuickParser._extract_date(text, today)
+        segments = [s for s in SEGMENT_RE.split(text) if s]
+        if len(segments) < 2:
+            return None
+        results = []
+        for segment in segments:
+            result = QuickParser.parse(segment, today)
+            if result is None:
+                return None
+            if shared_date and result["year"] is None:
+                result.update(year=shared_date.year, month=shared_date.month, day=shared_date.day)
+            results.append(result)
+        return results
+
+    @staticmethod
+    def _match(text, table):
+        for category, keywords in table.items():
+            if any(k in text for k in keywords):
+                return category
+        return None
+
+    @staticmethod
+    def _extract_date(text, today):
+        for word, offset in RELATIVE_DAYS:
+            if word in text:
+                return text.replace(word, " "), today + timedelta(days=offset)
+
+        match = WEEK_RE.search(text)
+        if match:
+            monday = today - timedelta(days=today.weekday())
+            if match.group(1) == "上":
+                monday -= timedelta(days=7)
+            return text.replace(match.group(0), " "), monday + timedelta(days=WEEKDAYS[match.group(2)])
+
+        for pattern in DATE_PATTERNS:
+            match = pattern.search(text)
+            if not match:
+                continue
+            year = chinese_to_number(match.group(1)) if match.group(1) else None
+            month = chinese_to_number(match.group(2)) if match.group(2) else today.month
+            day = chinese_to_number(match.group(3))
+            try:
+                record_date = date(int(year or today.year), int(month), int(day))
+            except (TypeError, ValueError):
+                continue
+            return text.replace(match.group(0), " "), record_date
+        return text, None
+
+    @staticmethod
+    def _extract_amount(text):
+        """挑選最可能是金額的數字，回傳 (金額, 移除金額後的文字, 是否帶貨幣單位)"""
+        candidates = []
+        for match in AMOUNT_RE.finditer(text):
+            raw = match.group(2)
+            value = chinese_to_number(raw)
+            if value is None:
+                continue
+            marked = bool(match.group(1) or match.group(3))
+            # 單一中文數字（如「一杯」的「一」）沒有貨幣單位時不視為金額
+            if not marked and not any(c.isdigit() for c in raw) and len(raw) == 1:
+                continue
+            if not marked and text[match.end():].lstrip().startswith(COUNTER_WORDS):
+                continue
+            prefix = text[max(0, match.start() - 2):match.start()]
+            if not marked and prefix.endswith(("花了", "付了", "賺了", "入帳", "花", "付")):
+                marked = True
+            candidates.append((marked, value, match))
+        if not candidates:
+            return None, text, False
+
+        marked_candidates = [c for c in candidates if c[0]]
+        if len(marked_candidates) == 1:
+            chosen = marked_candidates[0]
+        elif len(candidates) == 1:
+            chosen = candidates[0]
+        else:
+            # 多個數字時無法確定，交給 LLM 判斷
+            return None, text, False
+        marked, value, match = chosen
+        return value, text[:match.start()] + " " + text[match.end():], marked
+
+    @staticmethod
+    def _extract_item(text):
+        for verb in VERBS:
+            text = text.replace(verb, " ")
+        for keyword in ("入帳", "收入", "支出", "記帳", "共", "總共", "大概", "約"):
+            text = text.replace(keyword, " ")
+        text = re.sub(r"[\s,，.。!！~、:：]+", " ", text).strip()
+        return text.split(" ")[0] if text else ""
@@ -0,0 +1,152 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from PIL import Image
+
+# 收據多半是白底的紙張，8x8（64 位元）的雜湊無法區分同一家店的不同收據
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+REFRESH_MARGIN = timedelta(seconds=60)
+
+
+def dhash(image, size=HASH_SIZE):
+    """差異雜湊（dHash），回傳 size*size 位元整數；縮放、壓縮造成的差異只會改變少數位元"""
+    gray = image.convert("L").resize((size + 1, size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ReceiptCache:
+    """依使用者保存已處理收據的感知雜湊與解析結果，前面加一層記憶體快取
+
+    多個 worker 各有一份記憶體快取；本機沒有相符的收據時，會再向 MongoDB 讀取之後新增的雜湊。
+    """
+
+    def __init__(self, collection, threshold=8, max_users=1000, per_user=200):
+        self.collection = collection
+        self.threshold = threshold
+        self.max_users = max_users
+        self.per_user = per_user
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "hits": 0, "misses": 0}
+        try:
+            self.collection.create_index([("user_id", 1), ("created_at", -1)])
+        except Exception as e:
+            logging.error(f"receipt_cache: 建立索引失敗: {e}")
+
+    def _entries(self, user_id):
+        """回傳 (entries, 是否剛從 MongoDB 讀取)"""
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None:
+                self._users.move_to_end(user_id)
+                return cached[0], False
+        entries, since = self._load(user_id)
+        with self._lock:
+            self._users[user_id] = (entries, since)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return entries, True
+
+    def _load(self, user_id, since=None):
+        """讀取使用者的收據雜湊，指定 since 時只讀取該時間之後新增的，回傳 (entries, 最新的 created_at)"""
+        query = {"user_id": user_id}
+        if since is not None:
+            # 容許各程序間的時鐘誤差，重複的雜湊於合併時略過
+            query["created_at"] = {"$gt": since - REFRESH_MARGIN}
+        cursor = (
+            self.collection.find(query, {"_id": 0, "hash": 1, "result": 1, "created_at": 1})
+            .sort("created_at", -1)
+            .limit(self.per_user)
+        )
+        entries = []
+        latest = since
+        for doc in cursor:
+            if latest is None or doc["created_at"] > latest:
+                latest = doc["created_at"]
+            # 略過舊版 64 位元的雜湊，長度不同無法比較
+            if len(doc["hash"]) == HASH_BITS // 4:
+                entries.append((int(doc["hash"], 16), doc["result"]))
+        return entries, latest
+
+    def _refresh(self, user_id):
+        """本機沒有相符的收據時，讀取其他 worker 之後新增的雜湊"""
+        with self._lock:
+            cached = self._users.get(user_id)
+        since = cached[1] if cached is not None else None
+        fresh, latest = self._load(user_id, since)
+        with self._lock:
+            cached = self._users.get(user_id)
+            entries = cached[0] if cached is not None else []
+            known = {known_hash for known_hash, _ in entries}
+            added = [entry for entry in fresh if entry[0] not in known]
+            entries[:0] = added
+            del entries[self.per_user:]
+            self._users[user_id] = (entries, latest)
+        return added
+
+    def _match(self, entries, image_hash):
+        best = None
+        for known_hash, result in entries:
+            distance = hamming(known_hash, image_hash)
+            if distance <= self.threshold and (best is None or distance < best[0]):
+                best = (distance, result)
+        return best
+
+    def lookup(self, user_id, image_hash):
+        """找出漢明距離在門檻內的收據，回傳先前的解析結果或 None"""
+        try:
+            entries, loaded = self._entries(user_id)
+            best = self._match(entries, image_hash)
+            if best is None and not loaded:
+                best = self._match(self._refresh(user_id), image_hash)
+        except Exception as e:
+            logging.error(f"receipt_cache: 查詢失敗: {e}")
+            return None
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._stats["hits" if best else "misses"] += 1
+        if best:
+            logging.info(f"receipt_cache: 重複收據，距離 {best[0]}")
+            return best[1]
+        return None
+
+    def store(self, user_id, image_hash, records):
+        """保存一張收據記下的交易（可為多筆）"""
+        result = {"transactions": [
+            {k: v for k, v in record.items() if k not in ("_id", "created_at", "updated_at", "date")}
+            for record in records
+        ]}
+        try:
+            self.collection.insert_one({
+                "user_id": user_id,
+                "hash": f"{image_hash:0{HASH_BITS // 4}x}",
+                "result": result,
+                "created_at": datetime.now(),
+            })
+        except Exception as e:
+            logging.error(f"receipt_cache: 儲存失敗: {e}")
+            return
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None:
+                cached[0].insert(0, (image_hash, result))
+                del cached[0][self.per_user:]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+from script.metrics import metrics
+
+CACHE_EVENTS = metrics.counter(
+    "mybot_response_cache_total", "Chat response cache lookups and evictions", labels=("result",)
+)
+# 指涉使用者本身、先前對話或上下文的用語，這類問題的答案因人因對話而異
+PERSONAL_MARKERS = (
+    "我的", "我剛", "我上次", "我昨天", "我今天", "幫我", "記得", "剛剛", "剛才", "上面", "前面",
+    "之前", "你說", "你剛", "繼續", "再說", "再一次", "換個", "這個", "那個", "這些", "那些",
+    "它", "他", "她", "我們",
+)
+TRAILING = re.compile(r"[\s?？!！。.,，~～…]+$")
+SPACES = re.compile(r"\s+")
+
+
+def normalize_question(text):
+    """全半形、大小寫、空白與結尾標點一致化"""
+    text = unicodedata.normalize("NFKC", text).lower().strip()
+    text = TRAILING.sub("", text)
+    return SPACES.sub(" ", text)
+
+
+class ResponseCache:
+    """相同問題直接沿用先前的回覆
+
+    呼叫端對 cacheable() 的問題應不附帶對話歷史與摘要呼叫模型，存入與取用的回覆才都與上下文無關。
+    以正規化後的問題與 prompt/模型版本為鍵（version 可為函式，提示詞重新載入後舊的回覆自然失效），
+    記憶體 LRU 依位元組數上限淘汰；
+    指定 collection 時另存於 MongoDB，多個 worker 共用。用過網路搜尋的回覆 TTL 較短。
+    """
+
+    def __init__(self, version, ttl=6 * 3600, search_ttl=1800, max_bytes=8 * 1024 * 1024,
+                 min_length=4, max_length=200, collection=None):
+        self.version = version
+        self.ttl = ttl
+        self.search_ttl = search_ttl
+        self.max_bytes = max_bytes
+        self.min_length = min_length
+        self.max_length = max_length
+        self.collection = collection
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "skipped": 0, "stores": 0, "evictions": 0, "expired": 0}
+        if collection is not None:
+            try:
+                collection.create_index("expires_at", expireAfterSeconds=0)
+            except Exception as e:
+                logging.error(f"response_cache: 建立索引失敗: {e}")
+
+    def _count(self, result):
+        with self._lock:
+            self._stats[result] += 1
+        CACHE_EVENTS.inc(result=result)
+
+    def key(self, question):
+        version = self.version() if callable(self.version) else self.version
+        payload = f"{version}\n{normalize_question(question)}"
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def cacheable(self, question):
+        """過短的追問、過長的內容與涉及個人或上下文的問題不快取"""
+        text = normalize_question(question)
+        if not self.min_length <= len(text) <= self.max_length:
+            return False
+        return not any(marker in text for marker in PERSONAL_MARKERS)
+
+    def get(self, question):
+        if not self.cacheable(question):
+            self._count("skipped")
+            return None
+        key = self.key(question)
+        now = time.time()
+        expired = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                self._drop(key)
+                self._stats["expired"] += 1
+                entry, expired = None, True
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if expired:
+            CACHE_EVENTS.inc(result="expired")
+        if entry is None:
+            entry = self._load(key, now)
+        if entry is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return entry[0]
+
+    def put(self, question, response, used_search=False):
+        if not response or not self.cacheable(question):
+            return
+        key = self.key(question)
+        expires_at = time.time() + (self.search_ttl if used_search else self.ttl)
+        self._remember(key, response, expires_at)
+        self._count("stores")
+        if self.collection is not None:
+            try:
+                self.collection.update_one(
+                    {"_id": key},
+                    {"$set": {
+                        "response": response,
+                        "expires_at": datetime.fromtimestamp(expires_at, timezone.utc),
+                        "question": normalize_question(question),
+                    }},
+                    upsert=True,
+                )
+            except Exception as e:
+                logging.error(f"response_cache: 寫入失敗: {e}")
+
+    def _load(self, key, now):
+        if self.collection is None:
+            return None
+        try:
+            doc = self.collection.find_one(
+                {"_id": key, "expires_at": {"$gt": datetime.fromtimestamp(now, timezone.utc)}},
+                {"response": 1, "expires_at": 1},
+            )
+        except Exception as e:
+            logging.error(f"response_cache: 查詢失敗: {e}")
+            return None
+        if doc is None:
+            return None
+        # pymongo 預設回傳不含時區的 UTC 時間
+        expires_at = doc["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+        self._remember(key, doc["response"], expires_at)
+        return doc["response"], expires_at
+
+    def _remember(self, key, response, expires_at):
+        size = len(key) + len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        evicted = 0
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (response, expires_at, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                evicted += 1
+            self._stats["evictions"] += evicted
+        if evicted:
+            CACHE_EVENTS.inc(evicted, result="evictions")
+
+    def _drop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,108 @@
+"""由 records 重新計算 monthly_totals 並檢查差異
+
+首次部署時由 script.migrate 的 startup 在接受請求前執行一次 rebuild；
+之後可於專案根目錄執行：
+    python -m script.rollup check [--user USER_ID]
+    python -m script.rollup rebuild [--user USER_ID]
+"""
+import argparse
+import logging
+from datetime import datetime
+from pymongo import ReplaceOne
+from script.clients import registry
+from script.manay import encode_category
+
+
+def compute_totals(db, user_id=None):
+    """以聚合重新計算每位使用者每月的收支與分類加總"""
+    match = {'user_id': user_id} if user_id else {}
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': {
+                'user_id': '$user_id', 'year': '$year', 'month': '$month',
+                'type': '$type', 'category': '$category',
+            },
+            'total': {'$sum': '$amount'},
+            'count': {'$sum': 1},
+        }},
+    ]
+    totals = {}
+    for row in db.records.aggregate(pipeline, allowDiskUse=True):
+        key = (row['_id']['user_id'], row['_id']['year'], row['_id']['month'])
+        doc = totals.setdefault(key, {
+            'user_id': key[0], 'year': key[1], 'month': key[2],
+            'income': 0, 'expense': 0, 'count': 0, 'categories': {},
+        })
+        doc['count'] += row['count']
+        if row['_id']['type'] == '收入':
+            doc['income'] += row['total']
+        elif row['_id']['type'] == '支出':
+            doc['expense'] += row['total']
+            category = encode_category(row['_id'].get('category') or '其他')
+            doc['categories'][category] = doc['categories'].get(category, 0) + row['total']
+    return totals
+
+
+def find_drift(db, totals, user_id=None):
+    """比對現有 monthly_totals 與重新計算的結果，回傳不一致的 key"""
+    match = {'user_id': user_id} if user_id else {}
+    stored = {
+        (doc['user_id'], doc['year'], doc['month']): doc
+        for doc in db.monthly_totals.find(match)
+    }
+    drift = []
+    for key in set(stored) | set(totals):
+        expected = totals.get(key, {})
+        actual = stored.get(key, {})
+        fields = ('income', 'expense', 'count')
+        if any(expected.get(f, 0) != actual.get(f, 0) for f in fields):
+            drift.append(key)
+            continue
+        expected_categories = {k: v for k, v in expected.get('categories', {}).items() if v}
+        actual_categories = {k: v for k, v in actual.get('categories', {}).items() if v}
+        if expected_categories != actual_categories:
+            drift.append(key)
+    return sorted(drift, key=str)
+
+
+def rebuild(db, totals, drift):
+    now = datetime.now()
+    operations = []
+    for key in drift:
+        filter_ = {'user_id': key[0], 'year': key[1], 'month': key[2]}
+        if key in totals:
+            operations.append(ReplaceOne(filter_, {**totals[key], 'updated_at': now}, upsert=True))
+        else:
+            db.monthly_totals.delete_one(filter_)
+    if operations:
+        db.monthly_totals.bulk_write(operations, ordered=False)
+    return len(drift)
+
+
+def rebuild_all(db):
+    """修復所有與 records 不一致的月份，回傳修復的月份數；須在沒有並行寫入時執行"""
+    totals = compute_totals(db)
+    return rebuild(db, totals, find_drift(db, totals))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['check', 'rebuild'])
+    parser.add_argument('--user', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = registry.mongo()['accounting']
+    db.monthly_totals.create_index([('user_id', 1), ('year', 1), ('month', 1)], unique=True)
+    totals = compute_totals(db, args.user)
+    drift = find_drift(db, totals, args.user)
+    for key in drift:
+        print(f"drift: user={key[0]} {key[1]}-{key[2]}")
+    print(f"{len(totals)} 個月份，{len(drift)} 個不一致")
+    if args.command == 'rebuild' and drift:
+        print(f"已修復 {rebuild(db, totals, drift)} 個月份")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import re
+import threading
+from script.quick_parser import QuickParser, INCOME_KEYWORDS, EXPENSE_KEYWORDS
+from script.metrics import metrics
+
+BOOKKEEPING = "bookkeeping"
+ANALYSIS = "analysis"
+CHAT = "chat"
+UNKNOWN = "unknown"
+
+ANALYSIS_KEYWORDS = ("分析", "統計", "報表", "圓餅圖", "圖表", "收支")
+ANALYSIS_PATTERN = re.compile(
+    r"(這個月|本月|上個月|上月|今年|\d{1,2}\s*月|[一二三四五六七八九十]{1,2}\s*月).*(花費|消費|支出|收入|花了多少|開銷)"
+)
+DIGIT_PATTERN = re.compile(r"[\d零一二兩三四五六七八九十百千萬]")
+ROUTE_SECONDS = metrics.histogram(
+    "mybot_route_seconds", "End-to-end handling latency by intent route", labels=("route",)
+)
+
+
+class IntentRouter:
+    """在呼叫 LLM 前判斷訊息意圖：記帳、消費分析或一般聊天
+
+    無法確定時回傳 UNKNOWN，由呼叫端走原本「先記帳、無需求再聊天」的流程。
+    """
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def classify(self, message):
+        text = message.strip()
+        if any(k in text for k in ANALYSIS_KEYWORDS) or ANALYSIS_PATTERN.search(text):
+            return ANALYSIS
+        quick_result = QuickParser.parse(text)
+        if quick_result is not None and quick_result["confidence"] >= self.threshold:
+            return BOOKKEEPING
+        quick_results = QuickParser.parse_many(text)
+        if quick_results and min(r["confidence"] for r in quick_results) >= self.threshold:
+            return BOOKKEEPING
+        has_number = bool(DIGIT_PATTERN.search(text))
+        has_keyword = any(k in text for k in INCOME_KEYWORDS + EXPENSE_KEYWORDS)
+        if not has_number and not has_keyword:
+            return CHAT
+        return UNKNOWN
+
+    def record(self, route, elapsed):
+        """記錄單次處理的路由與耗時（秒）"""
+        ROUTE_SECONDS.observe(elapsed, route=route)
+        with self._lock:
+            stats = self._stats.setdefault(
+                route, {"count": 0, "latency_sum": 0.0, "latency_max": 0.0}
+            )
+            stats["count"] += 1
+            stats["latency_sum"] += elapsed
+            stats["latency_max"] = max(stats["latency_max"], elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                route: {
+                    "count": s["count"],
+                    "latency_avg": s["latency_sum"] / s["count"],
+                    "latency_max": s["latency_max"],
+                }
+                for route, s in self._stats.items()
+            }
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class SchedulerBusy(Exception):
+    """待處理事件超過上限，呼叫端應回覆忙碌訊息"""
+
+
+class _Task:
+    __slots__ = ("session_id", "user_id", "fn", "args", "future", "enqueued_at")
+
+    def __init__(self, session_id, user_id, fn, args):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class SessionScheduler:
+    """同一會話內依序處理、不同會話平行處理的事件排程器
+
+    - max_inflight：全域同時執行的事件數（即同時進行中的 OpenAI 呼叫上限）
+    - max_inflight_per_user：同一使用者跨會話同時執行的事件數
+    - max_backlog：待處理事件超過此數量時直接拒絕
+    """
+
+    def __init__(self, max_inflight=8, max_inflight_per_user=2, max_backlog=200):
+        self.max_inflight = max_inflight
+        self.max_inflight_per_user = max_inflight_per_user
+        self.max_backlog = max_backlog
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._ready = deque()
+        self._running = set()
+        self._user_inflight = {}
+        self._backlog = 0
+        self._waits = deque(maxlen=1000)
+        self._processed = 0
+        self._shed = 0
+        self._stopping = False
+        self._threads = []
+        for i in range(max_inflight):
+            thread = threading.Thread(
+                target=self._run, name=f"session-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, session_id, user_id, fn, *args):
+        """排入事件，回傳 Future；超過上限時拋出 SchedulerBusy"""
+        with self._cond:
+            if self._backlog >= self.max_backlog:
+                self._shed += 1
+                raise SchedulerBusy(f"backlog {self._backlog} >= {self.max_backlog}")
+            task = _Task(session_id, user_id, fn, args)
+            queue = self._queues.get(session_id)
+            if queue is None:
+                queue = self._queues[session_id] = deque()
+            queue.append(task)
+            self._backlog += 1
+            if len(queue) == 1 and session_id not in self._running:
+                self._ready.append(session_id)
+            self._cond.notify()
+        return task.future
+
+    def run(self, session_id, user_id, fn, *args):
+        """排入事件並等待其完成"""
+        return self.submit(session_id, user_id, fn, *args).result()
+
+    def shutdown(self, timeout=10):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """回傳佇列深度與等待時間統計（秒）"""
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "queue_depth": self._backlog,
+                "sessions_waiting": len(self._ready),
+                "in_flight": len(self._running),
+                "processed": self._processed,
+                "shed": self._shed,
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "wait_max": waits[-1] if waits else 0.0,
+            }
+
+    def _next_task(self):
+        """輪流挑選下一個可執行的會話，略過已達上限的使用者"""
+        for _ in range(len(self._ready)):
+            session_id = self._ready.popleft()
+            task = self._queues[session_id][0]
+            if self._user_inflight.get(task.user_id, 0) < self.max_inflight_per_user:
+                self._queues[session_id].popleft()
+                return task
+            self._ready.append(session_id)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                task = None
+                while not self._stopping:
+                    task = self._next_task()
+                    if task is not None:
+                        break
+                    self._cond.wait()
+                if task is None:
+                    return
+                self._backlog -= 1
+                self._running.add(task.session_id)
+                self._user_inflight[task.user_id] = self._user_inflight.get(task.user_id, 0) + 1
+                self._waits.append(time.monotonic() - task.enqueued_at)
+
+            try:
+                task.future.set_result(task.fn(*task.args))
+            except Exception as e:
+                logging.error(f"scheduler: 會話 {task.session_id} 處理失敗: {e}")
+                task.future.set_exception(e)
+
+            with self._cond:
+                self._processed += 1
+                self._running.discard(task.session_id)
+                inflight = self._user_inflight[task.user_id] - 1
+                if inflight:
+                    self._user_inflight[task.user_id] = inflight
+                else:
+                    del self._user_inflight[task.user_id]
+                if self._queues[task.session_id]:
+                    self._ready.append(task.session_id)
+                else:
+                    del self._queues[task.session_id]
+                self._cond.notify_all()
@@ -0,0 +1,123 @@
+import logging
+import re
+import threading
+from script.llm_gateway import gateway
+from script.metrics import metrics
+from script.prompts import prompts
+
+SEARCH = "search"
+NO_SEARCH = "no_search"
+UNSURE = "unsure"
+
+EXPLICIT_KEYWORDS = ("搜尋", "搜索", "查一下", "查查", "幫我查", "上網", "google", "谷歌", "網址", "官網", "來源")
+# 需要時效性資訊的用語與主題
+TIME_KEYWORDS = (
+    "今天", "明天", "後天", "昨天", "現在", "目前", "最新", "最近", "近期", "即時", "本週", "這週",
+    "下週", "這禮拜", "這個月", "下個月", "今年", "明年", "今晚", "剛剛發生",
+)
+FRESH_TOPICS = (
+    "天氣", "氣溫", "下雨", "颱風", "地震", "新聞", "股價", "股市", "匯率", "油價", "房價", "比分",
+    "賽程", "戰績", "票價", "營業時間", "開幕", "上映", "發售", "發布", "公告", "選舉", "疫情",
+    "多少錢", "價格", "評價", "排名", "推薦",
+)
+# 與先前對話、改寫或閒聊有關，答案只取決於上下文
+CONTEXT_KEYWORDS = (
+    "你剛", "你說", "剛剛說", "剛才說", "上面", "前面", "繼續", "再說", "再一次", "換個", "翻譯",
+    "改寫", "潤飾", "摘要", "整理", "縮短", "這段", "這句", "幫我寫", "寫一",
+)
+SMALL_TALK = (
+    "你好", "哈囉", "嗨", "早安", "午安", "晚安", "謝謝", "感謝", "哈哈", "掰掰", "好的", "好喔",
+    "ok", "嗯", "你是誰", "你叫什麼",
+)
+QUESTION_PATTERN = re.compile(r"(誰|哪裡|哪家|在哪|何時|什麼時候|幾點|多少|是否|有沒有|嗎|呢|\?|？)")
+# 英文專有名詞、型號與年份視為需要查證的具名實體
+ENTITY_PATTERN = re.compile(r"([A-Z][A-Za-z0-9]+|[A-Za-z]+\s?\d+|20\d\d\s*年?)")
+SEARCH_DECISIONS = metrics.counter(
+    "mybot_search_decisions_total", "Web search tool attachment decisions", labels=("decision", "reason")
+)
+
+
+def classify(text):
+    """以本機規則判斷是否需要網路搜尋，回傳 (SEARCH | NO_SEARCH | UNSURE, 原因)"""
+    normalized = text.strip().lower()
+    if not normalized:
+        return NO_SEARCH, "empty"
+    if any(k in normalized for k in EXPLICIT_KEYWORDS):
+        return SEARCH, "explicit"
+    if any(k in normalized for k in CONTEXT_KEYWORDS):
+        return NO_SEARCH, "context"
+    if len(normalized) <= 8 and any(k in normalized for k in SMALL_TALK):
+        return NO_SEARCH, "small_talk"
+    if any(k in normalized for k in TIME_KEYWORDS):
+        return SEARCH, "time"
+    if any(k in normalized for k in FRESH_TOPICS):
+        return SEARCH, "topic"
+    has_entity = bool(ENTITY_PATTERN.search(text))
+    if has_entity and QUESTION_PATTERN.search(normalized):
+        return SEARCH, "entity_question"
+    if has_entity or QUESTION_PATTERN.search(normalized):
+        return UNSURE, "entity" if has_entity else "question"
+    return NO_SEARCH, "default"
+
+
+class SearchPolicy:
+    """決定聊天呼叫是否附加 web_search 工具
+
+    大部分訊息由本機規則判斷；規則無法確定時，若設定 classifier_model 則以小模型判斷，
+    否則依 default 設定。不需要搜尋的閒聊與上下文問題可省下工具規劃與搜尋往返。
+    """
+
+    def __init__(self, enabled=True, default=False, classifier_model=None):
+        self.enabled = enabled
+        self.default = default
+        self.classifier_model = classifier_model
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def decide(self, text):
+        """回傳 (是否附加搜尋工具, 原因)"""
+        if not self.enabled:
+            return True, "disabled"
+        decision, reason = classify(text)
+        if decision == UNSURE:
+            if self.classifier_model:
+                use_search = self._ask_classifier(text)
+                reason = f"classifier_{reason}" if use_search is not None else f"default_{reason}"
+            else:
+                use_search, reason = None, f"default_{reason}"
+            if use_search is None:
+                use_search = self.default
+        else:
+            use_search = decision == SEARCH
+        self._record(use_search, reason)
+        return use_search, reason
+
+    def _ask_classifier(self, text):
+        try:
+            answer = gateway.create(
+                model=self.classifier_model,
+                input=[
+                    {"role": "system", "content": prompts.text("search_classifier")},
+                    {"role": "user", "content": text},
+                ],
+                prompt_name="search_classifier",
+            ).output_text.strip().lower()
+        except Exception as e:
+            logging.warning(f"search_policy: 分類呼叫失敗: {e}")
+            return None
+        if answer.startswith("yes"):
+            return True
+        if answer.startswith("no"):
+            return False
+        return None
+
+    def _record(self, use_search, reason):
+        decision = SEARCH if use_search else NO_SEARCH
+        SEARCH_DECISIONS.inc(decision=decision, reason=reason)
+        with self._lock:
+            counts = self._stats.setdefault(decision, {})
+            counts[reason] = counts.get(reason, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {decision: dict(counts) for decision, counts in self._stats.items()}
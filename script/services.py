@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from script.clients import registry, config
+from script.metrics import metrics
+from script.log_setup import setup_logging
+
+
+def preload():
+    """只匯入重量級模組、不建立任何連線或執行緒，供 fork 前在 master 執行
+
+    gunicorn preload_app 時各 worker 以 copy-on-write 共用這些模組的記憶體。
+    """
+    start = time.perf_counter()
+    import script.gai  # noqa: F401  langchain、tiktoken
+    import script.manay  # noqa: F401  matplotlib、PIL、pyheif
+    logging.info(f"services: 預先載入模組 {time.perf_counter() - start:.2f}s")
+
+
+def run_migrations():
+    """fork 前在 master 執行一次性的資料庫維護，完成後關閉連線，worker 再各自連線"""
+    from script.migrate import run_startup_migrations
+    try:
+        run_startup_migrations(registry.mongo()['accounting'])
+    except Exception as e:
+        logging.error(f"services: 資料庫維護失敗，下次啟動時重試: {e}")
+    finally:
+        registry.close()
+
+
+class Services:
+    """每個 worker 各自持有的聊天、記帳、排程與佇列元件
+
+    第一次使用或 start() 時才匯入模組並建立，因此匯入 main 不會連線資料庫，
+    也不會啟動背景執行緒，fork 前後都安全。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ai = None
+        self._ac = None
+        self._scheduler = None
+        self.event_queue = None
+        # 由 gunicorn 設定；多個程序時日誌分檔，圖表需先寫入儲存再回覆
+        self.worker_processes = 1
+        self._started = False
+
+    @property
+    def ai(self):
+        if self._ai is None:
+            with self._lock:
+                if self._ai is None:
+                    from script.gai import IntelligentChatAssistant
+                    self._ai = IntelligentChatAssistant()
+        return self._ai
+
+    @property
+    def ac(self):
+        if self._ac is None:
+            with self._lock:
+                if self._ac is None:
+                    from script.manay import Accounting
+                    self._ac = Accounting()
+        return self._ac
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            with self._lock:
+                if self._scheduler is None:
+                    from script.scheduler import SessionScheduler
+                    self._scheduler = SessionScheduler(
+                        max_inflight=config.get("max_inflight", 8),
+                        max_inflight_per_user=config.get("max_inflight_per_user", 2),
+                        max_backlog=config.get("max_backlog", 200),
+                    )
+        return self._scheduler
+
+    @property
+    def image_store(self):
+        from script.manay import get_image_store
+        return get_image_store()
+
+    @property
+    def image_processor(self):
+        from script.manay import image_processor
+        return image_processor
+
+    @property
+    def chart_renderer(self):
+        from script.manay import get_chart_renderer
+        return get_chart_renderer()
+
+    def start(self, dispatch):
+        """每個 worker 執行一次：設定日誌、建立連線與元件、啟動背景執行緒"""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            setup_logging(config.get("logging", {}), per_process=self.worker_processes > 1)
+            start = time.perf_counter()
+            components = ("ai", "ac", "scheduler", "chart_renderer")
+            try:
+                registry.mongo().admin.command("ping")
+            except Exception as e:
+                # 不在啟動時逐一等待逾時，依賴 MongoDB 的元件在第一次使用時才建立
+                logging.warning(f"services: MongoDB 連線失敗，稍後重試: {e}")
+                components = ("scheduler",)
+            registry.openai()
+            registry.line()
+            # 觸發延遲建立：匯入模組、建立索引、設定圖表字型
+            for component in components:
+                try:
+                    getattr(self, component)
+                except Exception as e:
+                    logging.error(f"services: 建立 {component} 失敗，第一次使用時重試: {e}")
+
+            try:
+                from script.image_store import start_gc
+                start_gc(self.image_store, config.get("image_store", {}).get("ttl", 30 * 86400))
+            except Exception as e:
+                logging.error(f"services: 啟動圖片清理失敗: {e}")
+            if config.get("async_webhook", False):
+                from script.event_queue import DurableEventQueue
+                self.event_queue = DurableEventQueue(
+                    config.get("queue_path", "queue/events.db"),
+                    dispatch,
+                    workers=config.get("queue_workers", 4),
+                    reply_token_ttl=config.get("reply_token_ttl", 60),
+                    max_outstanding=config.get("queue_max_outstanding", 100),
+                    max_attempts=config.get("queue_max_attempts", 3),
+                    retry_delay=config.get("queue_retry_delay", 2),
+                    retention=config.get("queue_retention", 7 * 86400),
+                )
+                self.event_queue.start()
+            self._register_gauges()
+            self._started = True
+            logging.info(f"services: worker 初始化完成 {time.perf_counter() - start:.2f}s")
+
+    def _register_gauges(self):
+        """將各元件的統計以 Prometheus gauge 輸出"""
+        metrics.gauge(
+            "mybot_scheduler", "Session scheduler queue depth and wait times",
+            lambda: {(k,): v for k, v in self.scheduler.stats().items()}, labels=("stat",),
+        )
+        metrics.gauge(
+            "mybot_receipt_cache", "Receipt perceptual-hash cache counters",
+            lambda: {(k,): v for k, v in self.ac.receipt_cache.stats().items()}, labels=("stat",),
+        )
+        metrics.gauge(
+            "mybot_history", "History compaction token and latency averages",
+            lambda: {(k,): v for k, v in self.ai.compactor.stats().items()}, labels=("stat",),
+        )
+        if self.event_queue is not None:
+            metrics.gauge(
+                "mybot_event_queue_pending", "Durable queue events not yet processed",
+                lambda: {(): self.event_queue.pending_count()},
+            )
+
+
+services = Services()
@@ -0,0 +1,196 @@
+import threading
+import time
+from concurrent.futures import Future
+import pytest
+from script.event_queue import DurableEventQueue
+from script.scheduler import SessionScheduler
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def make_event(session, index, timestamp=None):
+    return {
+        "replyToken": f"{session}-{index}",
+        "timestamp": timestamp if timestamp is not None else int(time.time() * 1000),
+        "session": session,
+        "index": index,
+    }
+
+
+def rows(queue):
+    with queue._lock:
+        return queue._conn.execute("SELECT status, attempts FROM events ORDER BY id").fetchall()
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = SessionScheduler(max_inflight=2, max_inflight_per_user=2)
+    yield scheduler
+    scheduler.shutdown(timeout=1)
+
+
+@pytest.fixture
+def queues():
+    created = []
+    yield created
+    for queue in created:
+        queue.stop(timeout=1)
+
+
+def test_workers_do_not_block_on_a_busy_session(tmp_path, scheduler, queues):
+    finished = []
+    lock = threading.Lock()
+
+    def work(event):
+        time.sleep(0.05)
+        with lock:
+            finished.append((event["session"], event["index"]))
+
+    def dispatch(destination, event):
+        return scheduler.submit(event["session"], event["session"], work, event)
+
+    queue = DurableEventQueue(str(tmp_path / "events.db"), dispatch, workers=1)
+    queues.append(queue)
+    queue.put_events("bot", [make_event("busy", i) for i in range(6)] + [make_event("other", 0)])
+    queue.start()
+    assert wait_until(lambda: len(finished) == 7)
+    assert finished.index(("other", 0)) <= 1
+    assert [i for s, i in finished if s == "busy"] == list(range(6))
+    assert wait_until(lambda: rows(queue) == [])
+
+
+def test_failed_future_marks_event_failed(tmp_path, scheduler, queues):
+    def fail(event):
+        raise RuntimeError("boom")
+
+    queue = DurableEventQueue(
+        str(tmp_path / "events.db"), lambda d, e: scheduler.submit("s", "u", fail, e), workers=1,
+    )
+    queues.append(queue)
+    queue.put_events("bot", [make_event("s", 0)])
+    queue.start()
+    # 處理函式已執行，可能已寫入記錄，不重試
+    assert wait_until(lambda: rows(queue) == [("failed", 1)])
+    time.sleep(0.1)
+    assert rows(queue) == [("failed", 1)]
+
+
+def test_dispatch_failure_is_retried_after_backoff(tmp_path, queues):
+    attempts = []
+
+    def dispatch(destination, event):
+        attempts.append(time.monotonic())
+        if len(attempts) < 2:
+            raise RuntimeError("boom")
+
+    queue = DurableEventQueue(
+        str(tmp_path / "events.db"), dispatch, workers=1, max_attempts=3, retry_delay=0.3,
+    )
+    queues.append(queue)
+    queue.put_events("bot", [make_event("s", 0)])
+    queue.start()
+    assert wait_until(lambda: len(attempts) == 2)
+    assert attempts[1] - attempts[0] >= 0.3
+    assert wait_until(lambda: rows(queue) == [])
+
+
+def test_dispatch_failure_stops_at_max_attempts(tmp_path, queues):
+    def dispatch(destination, event):
+        raise RuntimeError("boom")
+
+    queue = DurableEventQueue(
+        str(tmp_path / "events.db"), dispatch, workers=1, max_attempts=2, retry_delay=0.01,
+    )
+    queues.append(queue)
+    queue.put_events("bot", [make_event("s", 0)])
+    queue.start()
+    assert wait_until(lambda: rows(queue) == [("failed", 2)])
+
+
+def test_prune_removes_old_failed_and_expired_events(tmp_path):
+    queue = DurableEventQueue(str(tmp_path / "events.db"), lambda d, e: None, retention=60)
+    queue.put_events("bot", [make_event("s", i) for i in range(3)])
+    with queue._lock:
+        queue._conn.execute("UPDATE events SET status = 'failed' WHERE id = 1")
+        queue._conn.execute("UPDATE events SET status = 'expired' WHERE id = 2")
+    assert queue.prune(now=time.time() + 30) == 0
+    assert queue.prune(now=time.time() + 120) == 2
+    assert rows(queue) == [("pending", 0)]
+
+
+def test_expired_reply_token_is_not_dispatched(tmp_path, queues):
+    dispatched = []
+    queue = DurableEventQueue(
+        str(tmp_path / "events.db"), lambda d, e: dispatched.append(e), workers=1, reply_token_ttl=60,
+    )
+    queues.append(queue)
+    queue.put_events("bot", [make_event("s", 0, timestamp=int((time.time() - 120) * 1000))])
+    queue.start()
+    assert wait_until(lambda: rows(queue) and rows(queue)[0][0] == "expired")
+    assert dispatched == []
+
+
+def test_outstanding_events_are_bounded(tmp_path, queues):
+    futures = []
+
+    def dispatch(destination, event):
+        future = Future()
+        futures.append(future)
+        return future
+
+    queue = DurableEventQueue(str(tmp_path / "events.db"), dispatch, workers=2, max_outstanding=3)
+    queues.append(queue)
+    queue.put_events("bot", [make_event("s", i) for i in range(5)])
+    queue.start()
+    assert wait_until(lambda: len(futures) == 3)
+    time.sleep(0.1)
+    assert len(futures) == 3
+    for future in list(futures):
+        future.set_result(None)
+    assert wait_until(lambda: len(futures) == 5)
+    for future in futures[3:]:
+        future.set_result(None)
+    assert wait_until(lambda: rows(queue) == [])
+
+
+def test_second_process_does_not_reclaim_leased_events(tmp_path, queues):
+    path = str(tmp_path / "events.db")
+    held = []
+    first = DurableEventQueue(path, lambda d, e: held.append(e) or Future(), workers=1)
+    queues.append(first)
+    first.put_events("bot", [make_event("s", 0)])
+    first.start()
+    assert wait_until(lambda: len(held) == 1)
+
+    reclaimed = []
+    second = DurableEventQueue(path, lambda d, e: reclaimed.append(e), workers=1)
+    queues.append(second)
+    second.start()
+    time.sleep(0.2)
+    assert reclaimed == []
+    assert rows(second) == [("processing", 1)]
+
+
+def test_expired_lease_is_reclaimed(tmp_path, queues):
+    path = str(tmp_path / "events.db")
+    held = []
+    first = DurableEventQueue(path, lambda d, e: held.append(e) or Future(), workers=1, lease=0.1)
+    queues.append(first)
+    first.put_events("bot", [make_event("s", 0)])
+    first.start()
+    assert wait_until(lambda: len(held) == 1)
+    first.stop(timeout=1)
+
+    reclaimed = []
+    second = DurableEventQueue(path, lambda d, e: reclaimed.append(e), workers=1)
+    queues.append(second)
+    second.start()
+    assert wait_until(lambda: len(reclaimed) == 1)
+    assert wait_until(lambda: rows(second) == [])
@@ -0,0 +1,75 @@
+from datetime import date
+import pytest
+from script.quick_parser import QuickParser, chinese_to_number, round_amount
+
+TODAY = date(2026, 10, 18)
+THRESHOLD = 0.8
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("120", 120),
+    ("35,000", 35000),
+    ("12.5", 12.5),
+    ("兩千五", 2500),
+    ("三萬五", 35000),
+    ("3萬5", 35000),
+    ("一百零五", 105),
+    ("三百零八", 308),
+    ("一千零五十", 1050),
+    ("兩萬零五百", 20500),
+    ("十五", 15),
+    ("一二零", 120),
+    ("5k", 5000),
+    ("", None),
+    ("abc", None),
+])
+def test_chinese_to_number(text, expected):
+    assert chinese_to_number(text) == expected
+
+
+def test_round_amount_rounds_half_up():
+    assert round_amount(2.5) == 3
+    assert round_amount(2.4) == 2
+    assert round_amount(120) == 120
+
+
+@pytest.mark.parametrize("message, amount, category", [
+    ("午餐 120元", 120, "飲食"),
+    ("搭計程車 花了兩千五", 2500, "交通"),
+    ("一百零五元 早餐", 105, "飲食"),
+    ("咖啡 2.5元", 3, "飲食"),
+    ("買了3杯咖啡 150元", 150, "飲食"),
+    ("晚餐吃了2碗麵 180", 180, "飲食"),
+])
+def test_parse_amount(message, amount, category):
+    result = QuickParser.parse(message, today=TODAY)
+    assert result["confidence"] >= THRESHOLD
+    assert (result["amount"], result["category"]) == (amount, category)
+
+
+def test_parse_income_and_date():
+    result = QuickParser.parse("昨天薪水入帳 35000", today=TODAY)
+    assert (result["type"], result["amount"], result["category"]) == ("收入", 35000, "工作")
+    assert (result["year"], result["month"], result["day"]) == (2026, 10, 17)
+
+
+@pytest.mark.parametrize("message", ["買了3杯咖啡", "晚餐吃了2碗麵", "喝了2杯珍奶", "搭了3站捷運"])
+def test_counts_are_not_amounts(message):
+    result = QuickParser.parse(message, today=TODAY)
+    assert result is None or result["confidence"] < THRESHOLD
+
+
+@pytest.mark.parametrize("message", ["這個月花了多少？", "幫我分析這個月的花費", "今天天氣如何"])
+def test_questions_are_not_bookkeeping(message):
+    assert QuickParser.parse(message, today=TODAY) is None
+
+
+def test_parse_many_splits_segments_and_shares_date():
+    results = QuickParser.parse_many("昨天 早餐50 午餐120", today=TODAY)
+    assert [r["amount"] for r in results] == [50, 120]
+    assert all(r["day"] == 17 for r in results)
+
+
+def test_parse_many_requires_every_segment():
+    assert QuickParser.parse_many("早餐50 買了2杯咖啡", today=TODAY) is None
+    assert QuickParser.parse_many("午餐 120元", today=TODAY) is None
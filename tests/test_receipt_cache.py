@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+import pytest
+
+pytest.importorskip("PIL")
+from script.receipt_cache import ReceiptCache  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction):
+        self.docs = sorted(self.docs, key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeCollection:
+    """兩個 ReceiptCache 共用，模擬兩個 worker 連到同一個 MongoDB"""
+
+    def __init__(self):
+        self.docs = []
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+    def find(self, query, projection=None):
+        docs = [doc for doc in self.docs if doc["user_id"] == query["user_id"]]
+        if "created_at" in query:
+            docs = [doc for doc in docs if doc["created_at"] > query["created_at"]["$gt"]]
+        return FakeCursor(docs)
+
+
+def test_receipt_stored_by_another_worker_is_found():
+    collection = FakeCollection()
+    first, second = ReceiptCache(collection), ReceiptCache(collection)
+    assert second.lookup("u1", 0b1010) is None  # 載入並快取空的列表
+    first.store("u1", 0b1010, [{"item": "咖啡", "amount": 60}])
+    assert second.lookup("u1", 0b1011) == {"transactions": [{"item": "咖啡", "amount": 60}]}
+
+
+def test_refresh_does_not_duplicate_local_entries():
+    collection = FakeCollection()
+    cache = ReceiptCache(collection)
+    collection.insert_one({
+        "user_id": "u1", "hash": f"{1:064x}", "result": {"transactions": []},
+        "created_at": datetime.now() - timedelta(days=1),
+    })
+    assert cache.lookup("u1", 1) is not None
+    cache.store("u1", 1 << 200, [])
+    assert cache.lookup("u1", (1 << 256) - 1) is None
+    hashes = [known for known, _ in cache._users["u1"][0]]
+    assert len(hashes) == len(set(hashes)) == 2
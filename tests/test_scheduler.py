@@ -0,0 +1,110 @@
+import threading
+import time
+import pytest
+from script.scheduler import SessionScheduler, SchedulerBusy
+
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+
+    def make(**kwargs):
+        scheduler = SessionScheduler(**kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.shutdown(timeout=1)
+
+
+def test_same_session_runs_in_order_and_never_concurrently(make_scheduler):
+    scheduler = make_scheduler(max_inflight=4, max_inflight_per_user=4)
+    order, active, overlaps = [], [], []
+    lock = threading.Lock()
+
+    def work(i):
+        with lock:
+            active.append(i)
+            if len(active) > 1:
+                overlaps.append(i)
+        time.sleep(0.01)
+        with lock:
+            active.remove(i)
+            order.append(i)
+
+    futures = [scheduler.submit("s1", "u1", work, i) for i in range(6)]
+    for future in futures:
+        future.result(timeout=5)
+    assert order == list(range(6))
+    assert overlaps == []
+
+
+def test_other_session_is_not_stuck_behind_busy_session(make_scheduler):
+    scheduler = make_scheduler(max_inflight=2, max_inflight_per_user=2)
+    finished = []
+    lock = threading.Lock()
+
+    def work(name):
+        time.sleep(0.05)
+        with lock:
+            finished.append(name)
+
+    futures = [scheduler.submit("busy", "u1", work, f"busy{i}") for i in range(6)]
+    futures.append(scheduler.submit("other", "u2", work, "other"))
+    for future in futures:
+        future.result(timeout=5)
+    # 同一會話依序執行，另一個會話可立即使用空閒的名額
+    assert finished.index("other") == 0
+
+
+def test_per_user_cap_limits_concurrency_across_sessions(make_scheduler):
+    scheduler = make_scheduler(max_inflight=4, max_inflight_per_user=1)
+    running = {"u1": 0}
+    peak = {"u1": 0}
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running["u1"] += 1
+            peak["u1"] = max(peak["u1"], running["u1"])
+        time.sleep(0.02)
+        with lock:
+            running["u1"] -= 1
+
+    futures = [scheduler.submit(f"s{i}", "u1", work) for i in range(4)]
+    for future in futures:
+        future.result(timeout=5)
+    assert peak["u1"] == 1
+
+
+def test_backlog_limit_sheds_new_events(make_scheduler):
+    scheduler = make_scheduler(max_inflight=1, max_inflight_per_user=1, max_backlog=2)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    running = scheduler.submit("s0", "u0", block)
+    assert started.wait(5)
+    queued = [scheduler.submit(f"s{i}", f"u{i}", lambda: None) for i in (1, 2)]
+    with pytest.raises(SchedulerBusy):
+        scheduler.submit("s3", "u3", lambda: None)
+    release.set()
+    for future in [running, *queued]:
+        future.result(timeout=5)
+    assert scheduler.stats()["shed"] == 1
+
+
+def test_exception_is_set_on_future(make_scheduler):
+    scheduler = make_scheduler(max_inflight=1)
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        scheduler.submit("s1", "u1", fail).result(timeout=5)
+    # 失敗後同一會話仍可繼續處理
+    assert scheduler.submit("s1", "u1", lambda: 42).result(timeout=5) == 42